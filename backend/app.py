@@ -1,36 +1,35 @@
-from flask import Flask, request, jsonify, Response, stream_template, send_from_directory, session
+from flask import Flask, Blueprint, current_app, request, jsonify, Response, stream_template, send_from_directory, session
 from flask_cors import CORS
-from gemini import generate_question, evaluate_answer, answer_direct_question, generate_question_stream, evaluate_answer_stream, answer_direct_question_stream, is_correct_answer
+from gemini import generate_question, evaluate_answer, answer_direct_question, generate_question_stream, evaluate_answer_stream, answer_direct_question_stream, is_correct_answer, generate_question_set_stream, MAX_SET_SIZE
 import jwt
 import datetime
 from functools import wraps
 import os
-from werkzeug.security import generate_password_hash, check_password_hash
+from credentials import hash_password, verify_password, HashingBusy
+from ratelimit import rate_limit, charge_quota
+from responses import OrjsonProvider, raw_json_response, compress_response
+import instrumentation
+import profiling
+import usage
+import question_bank
 import psycopg2
 import psycopg2.extras
 from werkzeug.utils import secure_filename
-from db import create_tables, log_interaction, save_chat_history, get_user_chat_history, get_chat_by_id, delete_chat_history, get_db_connection, update_chat_history_messages
+from db import ensure_schema, create_user, update_user_password, log_interaction, log_interactions, save_chat_history, get_user_chat_history_json, get_chat_json, get_chat_owner, search_chat_history, delete_chat_history, get_db_connection, update_chat_history_messages
 import json
 from dotenv import load_dotenv
 import time
+import uuid
 
 load_dotenv()
 
-app = Flask(__name__)
-
 # Allow your Vercel frontend to make requests to this backend
 cors_origins = [
     "https://ai-conversational-math-evaluation-c.vercel.app",
     "http://localhost:3000"  # for local development
 ]
 
-CORS(app, resources={r"/*": {"origins": cors_origins}}, supports_credentials=True)
-
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', '33086545ed2fa90350b6e7ebc1470ed3d117175c03396d0c25c05b613abaa847')
-
-
-# Initialize database tables
-create_tables()
+api = Blueprint('api', __name__)
 
 # JWT token required decorator
 def token_required(f):
@@ -44,7 +43,7 @@ def token_required(f):
             return jsonify({'message': 'Token is missing!'}), 401
         
         try:
-            data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+            data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=["HS256"])
             conn = get_db_connection()
             cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
             cursor.execute('SELECT * FROM users WHERE id = %s', (data['user_id'],))
@@ -54,6 +53,9 @@ def token_required(f):
 
             if not current_user:
                 return jsonify({'message': 'User not found!'}), 401
+
+            # Attribute any model calls made for this request
+            usage.set_request_context(request.endpoint.rsplit('.', 1)[-1], current_user['id'])
         except Exception as e:
             print(f"Token validation error: {e}")
             return jsonify({'message': 'Token is invalid!'}), 401
@@ -62,38 +64,40 @@ def token_required(f):
     
     return decorated
 
-@app.route('/register', methods=['POST'])
+def bank_question(user_id, grade, subject, topic, difficulty, language):
+    """An unseen curated question for this user, or None to fall back to Gemini"""
+    if not question_bank.QUESTION_BANK_ENABLED:
+        return None
+    try:
+        row = question_bank.draw(user_id, grade, subject, topic, difficulty, language)
+    except psycopg2.Error as e:
+        print(f"Error reading question bank: {e}")
+        return None
+    return row['question'] if row else None
+
+@api.route('/register', methods=['POST'])
+@rate_limit('register', by='ip')
 def register():
     data = request.json
 
     try:
-        # Check if user already exists
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cursor.execute('SELECT * FROM users WHERE email = %s', (data['email'],))
-        user = cursor.fetchone()
+        # Hash off the request thread, then let the UNIQUE email constraint reject duplicates
+        hashed_password = hash_password(data['password'])
+        user_id = create_user(data['name'], data['email'], hashed_password)
 
-        if user:
-            cursor.close()
-            conn.close()
+        if user_id is None:
             return jsonify({'message': 'User already exists!'}), 409
 
-        # Create new user
-        hashed_password = generate_password_hash(data['password'])
-
-        cursor.execute('INSERT INTO users (name, email, password) VALUES (%s, %s, %s)',
-                      (data['name'], data['email'], hashed_password))
-        conn.commit()
-        cursor.close()
-        conn.close()
-
         return jsonify({'message': 'User created successfully!'}), 201
 
+    except HashingBusy:
+        return jsonify({'message': 'Server busy, please try again.'}), 503, {'Retry-After': '1'}
     except psycopg2.Error as e:
         print(f"Database error during registration: {e}")
         return jsonify({'message': 'Registration failed!'}), 500
 
-@app.route('/login', methods=['POST'])
+@api.route('/login', methods=['POST'])
+@rate_limit('login', by='ip')
 def login():
     data = request.json
 
@@ -111,30 +115,42 @@ def login():
         if not user:
             return jsonify({'message': 'User not found!'}), 401
 
-        if check_password_hash(user['password'], data['password']):
+        valid, new_hash = verify_password(user['password'], data['password'])
+
+        if valid:
+            # Upgrade hashes made with older algorithm/cost settings
+            if new_hash:
+                try:
+                    update_user_password(user['id'], new_hash)
+                except psycopg2.Error as e:
+                    print(f"Error upgrading password hash: {e}")
+
             # Generate token
             token = jwt.encode({
                 'user_id': user['id'],
                 'name': user['name'],
                 'email': user['email'],
                 'exp': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=7)
-            }, app.config['SECRET_KEY'], algorithm="HS256")
+            }, current_app.config['SECRET_KEY'], algorithm="HS256")
 
             return jsonify({'token': token})
 
         return jsonify({'message': 'Invalid credentials!'}), 401
 
+    except HashingBusy:
+        return jsonify({'message': 'Server busy, please try again.'}), 503, {'Retry-After': '1'}
     except psycopg2.Error as e:
         print(f"Database error during login: {e}")
         return jsonify({'message': 'Login failed!'}), 500
 
-@app.route('/logout', methods=['POST'])
+@api.route('/logout', methods=['POST'])
 def logout():
     session.clear()
     return jsonify({"message": "Logout successful"})
 
-@app.route("/generate", methods=["POST"])
+@api.route("/generate", methods=["POST"])
 @token_required
+@rate_limit('generate', quota=False)
 def ask_question(current_user):
     data = request.json
     grade = data.get("grade")
@@ -143,8 +159,14 @@ def ask_question(current_user):
     difficulty = data.get("difficultyLevel", 1)
     language = data.get("language", "English")
     
-    # Generate question using Gemini API
-    question = generate_question(grade, subject, topic, difficulty, language)
+    # Serve a curated question if there is one; otherwise generate with Gemini API
+    question = bank_question(current_user['id'], grade, subject, topic, difficulty, language)
+    if question is None:
+        # Only the LLM fallback counts against the daily quota
+        over_quota = charge_quota(current_user['id'], 'generate')
+        if over_quota is not None:
+            return over_quota
+        question = generate_question(grade, subject, topic, difficulty, language)
     
     # Log the interaction
     try:
@@ -161,8 +183,9 @@ def ask_question(current_user):
     
     return jsonify({"question": question})
 
-@app.route("/answer", methods=["POST"])
+@api.route("/answer", methods=["POST"])
 @token_required
+@rate_limit('answer')
 def answer_question(current_user):
     data = request.json
     question = data.get("question")
@@ -196,8 +219,9 @@ def answer_question(current_user):
     
     return jsonify({"feedback": feedback})
 
-@app.route("/direct_question", methods=["POST"])
+@api.route("/direct_question", methods=["POST"])
 @token_required
+@rate_limit('direct_question')
 def direct_question(current_user):
     data = request.json
     question = data.get("question")
@@ -228,17 +252,15 @@ def direct_question(current_user):
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'pdf', 'txt'}
 
-# Make sure the upload folder exists
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-
 # Helper function to check allowed file extensions
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 # Add this new route to handle file uploads
-@app.route("/upload_question", methods=["POST"])
+@api.route("/upload_question", methods=["POST"])
 @token_required
+@rate_limit('upload_question')
 def upload_question(current_user):
     if 'file' not in request.files:
         return jsonify({"error": "No file part"}), 400
@@ -293,13 +315,12 @@ def upload_question(current_user):
     return jsonify({"error": "File type not allowed"}), 400
 
 # Add these new endpoints for chat history
-@app.route("/chat_history", methods=["GET", "POST"])
+@api.route("/chat_history", methods=["GET", "POST"])
 @token_required
 def chat_history(current_user):
     if request.method == "GET":
         # Get all chat history for the user
-        history = get_user_chat_history(current_user['id'])
-        return jsonify(history)
+        return raw_json_response(get_user_chat_history_json(current_user['id']))
     
     elif request.method == "POST":
         # Save new chat history
@@ -310,17 +331,38 @@ def chat_history(current_user):
         history_id = save_chat_history(current_user['id'], title, messages)
         return jsonify({"id": history_id, "message": "Chat history saved successfully"})
 
-@app.route("/chat_history/<int:chat_id>", methods=["GET", "PUT", "DELETE", "POST"])
+@api.route("/chat_history/search", methods=["GET"])
+@token_required
+def chat_history_search(current_user):
+    # Each result's "snippet" is escaped HTML whose only tags are <mark>...</mark>
+    # around the matched words, so it can be rendered as HTML or stripped to text
+    query = request.args.get("q", "").strip()
+    if not query:
+        return jsonify({"message": "Missing search query"}), 400
+
+    try:
+        limit = max(1, min(int(request.args.get("limit", 20)), 50))
+        after = None
+        if request.args.get("cursor"):
+            rank, chat_id = request.args["cursor"].split(":")
+            after = (float(rank), int(chat_id))
+    except ValueError:
+        return jsonify({"message": "Invalid limit or cursor"}), 400
+
+    results, next_cursor = search_chat_history(current_user['id'], query, limit, after)
+    return jsonify({"results": results, "next_cursor": next_cursor})
+
+@api.route("/chat_history/<int:chat_id>", methods=["GET", "PUT", "DELETE", "POST"])
 @token_required
 def manage_chat_history(current_user, chat_id):
     if request.method == "GET":
         # Get a specific chat history
-        chat = get_chat_by_id(chat_id)
+        chat_json = get_chat_json(chat_id, current_user['id'])
         
-        if not chat or chat['user_id'] != current_user['id']:
+        if chat_json is None:
             return jsonify({"message": "Chat history not found"}), 404
         
-        return jsonify(chat)
+        return raw_json_response(chat_json)
     
     elif request.method == "PUT" or request.method == "POST": # Handle update and sendBeacon
         # Update chat history
@@ -332,8 +374,7 @@ def manage_chat_history(current_user, chat_id):
             return jsonify({"message": "Missing title or messages"}), 400
 
         # Ensure the user owns this chat before updating
-        chat = get_chat_by_id(chat_id)
-        if not chat or chat['user_id'] != current_user['id']:
+        if get_chat_owner(chat_id) != current_user['id']:
             return jsonify({"message": "Chat not found or not authorized"}), 404
 
         update_chat_history_messages(chat_id, title, messages)
@@ -342,16 +383,16 @@ def manage_chat_history(current_user, chat_id):
     elif request.method == "DELETE":
         # Delete chat history
         # Ensure the user owns this chat before deleting
-        chat = get_chat_by_id(chat_id)
-        if not chat or chat['user_id'] != current_user['id']:
+        if get_chat_owner(chat_id) != current_user['id']:
             return jsonify({"message": "Chat history not found or not authorized"}), 404
 
         delete_chat_history(chat_id, current_user['id'])
         return jsonify({"message": "Chat history deleted successfully"})
 
 # Streaming endpoints for real-time responses
-@app.route("/generate_stream", methods=["POST"])
+@api.route("/generate_stream", methods=["POST"])
 @token_required
+@rate_limit('generate_stream', quota=False)
 def ask_question_stream(current_user):
     data = request.json
     grade = data.get("grade")
@@ -360,10 +401,19 @@ def ask_question_stream(current_user):
     difficulty = data.get("difficultyLevel", 1)
     language = data.get("language", "English")
 
+    # Serve a curated question if there is one; otherwise stream from Gemini
+    banked = bank_question(current_user['id'], grade, subject, topic, difficulty, language)
+    if banked is None:
+        # Only the LLM fallback counts against the daily quota
+        over_quota = charge_quota(current_user['id'], 'generate_stream')
+        if over_quota is not None:
+            return over_quota
+
     def generate():
         try:
             full_response = ""
-            for chunk in generate_question_stream(grade, subject, topic, difficulty, language):
+            chunks = [banked] if banked else generate_question_stream(grade, subject, topic, difficulty, language)
+            for chunk in chunks:
                 full_response += chunk
                 # Send each chunk as Server-Sent Events
                 yield f"data: {{\"chunk\": {json.dumps(chunk)}, \"done\": false}}\n\n"
@@ -390,8 +440,66 @@ def ask_question_stream(current_user):
 
     return Response(generate(), mimetype='text/plain')
 
-@app.route("/answer_stream", methods=["POST"])
+@api.route("/generate_set", methods=["POST"])
+@token_required
+@rate_limit('generate_set')
+def generate_set_stream(current_user):
+    data = request.json
+    grade = data.get("grade")
+    subject = data.get("subject", "Math")
+    topics = data.get("topics") or ([data["topic"]] if data.get("topic") else None)
+    difficulty = data.get("difficultyLevel")
+    language = data.get("language", "English")
+
+    if topics is not None and (not isinstance(topics, list) or not all(isinstance(t, str) for t in topics)):
+        return jsonify({"error": "topics must be a list of strings"}), 400
+
+    try:
+        count = max(1, min(int(data.get("count", 10)), MAX_SET_SIZE))
+    except (TypeError, ValueError):
+        return jsonify({"error": "count must be a number"}), 400
+
+    # Leaving difficultyLevel out asks for a mix of difficulties
+    if difficulty not in (None, ""):
+        try:
+            difficulty = max(1, min(int(difficulty), 3))
+        except (TypeError, ValueError):
+            return jsonify({"error": "difficultyLevel must be 1, 2 or 3"}), 400
+    else:
+        difficulty = None
+
+    def generate():
+        questions = []
+        try:
+            for item in generate_question_set_stream(grade, subject, count, topics, difficulty, language):
+                questions.append(item)
+                # Send each question as soon as it has been parsed
+                yield f"data: {json.dumps({'index': len(questions) - 1, 'question': item, 'done': False})}\n\n"
+
+            # Send completion signal
+            yield f"data: {json.dumps({'count': len(questions), 'done': True})}\n\n"
+
+            # Log the whole set in a single round-trip, tagged as one request
+            set_id = uuid.uuid4().hex
+            try:
+                log_interactions([{
+                    'grade': grade,
+                    'subject': subject,
+                    'topic': item['topic'],
+                    'question': item['question'],
+                    'set_id': set_id
+                } for item in questions])
+            except Exception as e:
+                print(f"Error logging interaction: {e}")
+
+        except Exception as e:
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+
+    return Response(generate(), mimetype='text/plain')
+
+@api.route("/answer_stream", methods=["POST"])
 @token_required
+@rate_limit('answer_stream')
 def answer_question_stream(current_user):
     data = request.json
     question = data.get("question")
@@ -445,8 +553,9 @@ def answer_question_stream(current_user):
             yield f"data: {json.dumps({'error': str(e)})}\n\n"
     return Response(generate(), mimetype='text/plain')
 
-@app.route("/direct_question_stream", methods=["POST"])
+@api.route("/direct_question_stream", methods=["POST"])
 @token_required
+@rate_limit('direct_question_stream')
 def direct_question_stream(current_user):
     data = request.json
     question = data.get("question")
@@ -486,7 +595,7 @@ def direct_question_stream(current_user):
     return Response(generate(), mimetype='text/plain')
 
 # Admin endpoints
-@app.route('/admin/tables', methods=['POST'])
+@api.route('/admin/tables', methods=['POST'])
 def admin_tables():
     data = request.json
     password = data.get('password')
@@ -504,7 +613,7 @@ def admin_tables():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/admin/table_data', methods=['POST'])
+@api.route('/admin/table_data', methods=['POST'])
 def admin_table_data():
     data = request.json
     password = data.get('password')
@@ -524,5 +633,82 @@ def admin_table_data():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Profiling endpoints (admin only)
+def _is_admin(data):
+    return data is not None and data.get('password') == os.getenv('ADMIN_PASSWORD', 'admin123')
+
+@api.route('/admin/profile', methods=['POST'])
+def admin_profile():
+    data = request.json
+    if not _is_admin(data):
+        return jsonify({'error': 'Unauthorized'}), 401
+    try:
+        seconds = int(data.get('seconds', 10))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'seconds must be a number'}), 400
+    name = profiling.start_session(seconds)
+    if name is None:
+        return jsonify({'error': 'A profiling session is already running in this worker'}), 409
+    return jsonify({'profile': name, 'pid': os.getpid()}), 202
+
+@api.route('/admin/profiles', methods=['POST'])
+def admin_profiles():
+    if not _is_admin(request.json):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify({'profiles': profiling.list_profiles()})
+
+@api.route('/admin/profiles/<path:filename>', methods=['POST'])
+def admin_profile_download(filename):
+    if not _is_admin(request.json):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return send_from_directory(os.path.abspath(profiling.PROFILE_DIR), filename, as_attachment=True)
+
+@api.route('/admin/usage', methods=['POST'])
+def admin_usage():
+    data = request.json
+    if not _is_admin(data):
+        return jsonify({'error': 'Unauthorized'}), 401
+    group_by = data.get('group_by', 'endpoint')
+    if group_by not in usage.REPORT_GROUPS:
+        return jsonify({'error': f"group_by must be one of {', '.join(usage.REPORT_GROUPS)}"}), 400
+    try:
+        days = max(1, int(data.get('days', 7)))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'days must be a number'}), 400
+    try:
+        return jsonify({'group_by': group_by, 'days': days, 'usage': usage.report(days, group_by)})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def create_app():
+    """Build the Flask app.
+
+    Importing this module stays cheap: the Gemini client is loaded on first use
+    and the schema check runs once per process. Under gunicorn --preload (see
+    gunicorn.conf.py) this runs once in the master and workers share its memory.
+    """
+    app = Flask(__name__)
+    app.json = OrjsonProvider(app)
+    app.after_request(compress_response)
+
+    CORS(app, resources={r"/*": {"origins": cors_origins}}, supports_credentials=True)
+
+    app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', '33086545ed2fa90350b6e7ebc1470ed3d117175c03396d0c25c05b613abaa847')
+
+    app.register_blueprint(api)
+    instrumentation.init_app(app)
+    profiling.init_app(app)
+    usage.init_app(app)
+
+    # Initialize database tables
+    ensure_schema()
+
+    # Make sure the upload folder exists
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+
+    return app
+
+app = create_app()
+
 if __name__ == "__main__":
     app.run(debug=True)
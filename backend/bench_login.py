@@ -0,0 +1,124 @@
+"""Login throughput benchmark.
+
+Local mode measures verify_password throughput through the bounded hashing
+executor for the configured algorithm (set PASSWORD_HASH_METHOD and the cost
+variables to compare settings):
+
+    python bench_login.py --threads 8 --seconds 10
+
+HTTP mode hammers /login on a running backend with an existing account. Run
+the target with RATE_LIMIT_ENABLED=false, or the per-IP /login limit turns
+almost every request into a 429:
+
+    RATE_LIMIT_ENABLED=false gunicorn app:app
+    python bench_login.py --url http://localhost:8000 --email a@b.c --password secret --threads 16
+
+Throughput and latency percentiles only count successful logins. Calls shed
+with HashingBusy (or a 503/429 over HTTP) are reported on their own line and
+retried after a short back-off, so they neither inflate the numbers nor spin
+on the GIL that the hashing threads need.
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+
+REJECT_BACKOFF_SECONDS = 0.05
+
+OK, REJECTED, FAILED = 'ok', 'rejected', 'failed'
+
+
+def _local_call(stored_hash, password):
+    from credentials import verify_password, HashingBusy
+    try:
+        ok, _ = verify_password(stored_hash, password)
+        return OK if ok else FAILED
+    except HashingBusy:
+        return REJECTED
+
+
+def _http_call(url, email, password):
+    body = json.dumps({'email': email, 'password': password}).encode()
+    req = urllib.request.Request(url.rstrip('/') + '/login', data=body,
+                                 headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            return OK if resp.status == 200 else FAILED
+    except urllib.error.HTTPError as e:
+        return REJECTED if e.code in (429, 503) else FAILED
+    except urllib.error.URLError:
+        return FAILED
+
+
+def run(call, threads, seconds):
+    latencies = []
+    counts = {OK: 0, REJECTED: 0, FAILED: 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            outcome = call()
+            elapsed = time.perf_counter() - start
+            with lock:
+                counts[outcome] += 1
+                if outcome == OK:
+                    latencies.append(elapsed)
+            if outcome == REJECTED:
+                time.sleep(REJECT_BACKOFF_SECONDS)
+
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+
+    latencies.sort()
+    total = len(latencies)
+    print(f"logins:     {total} in {seconds}s with {threads} threads")
+    print(f"rejected:   {counts[REJECTED]} (shed as busy or rate limited, not counted below)")
+    print(f"failed:     {counts[FAILED]}")
+    if not total:
+        print("No logins completed")
+        return
+    print(f"throughput: {total / seconds:.1f} logins/s")
+    print(f"p50:        {statistics.median(latencies) * 1000:.1f} ms")
+    print(f"p95:        {latencies[max(int(total * 0.95) - 1, 0)] * 1000:.1f} ms")
+    print(f"max:        {latencies[-1] * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='Backend base URL; omit to benchmark hashing in-process')
+    parser.add_argument('--email', default='bench@example.com')
+    parser.add_argument('--password', default='correct horse battery staple')
+    parser.add_argument('--threads', type=int,
+                        help='default: hashing workers + queue slots in-process, 8 over HTTP')
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args()
+
+    threads = args.threads
+    if args.url:
+        call = lambda: _http_call(args.url, args.email, args.password)
+        threads = threads or 8
+    else:
+        import credentials
+        capacity = credentials.HASH_WORKERS + credentials.HASH_QUEUE_SIZE
+        print(f"method:     {credentials.HASH_METHOD} ({credentials.HASH_WORKERS} hashing workers, "
+              f"{credentials.HASH_QUEUE_SIZE} queue slots)")
+        threads = threads or capacity
+        if threads > capacity:
+            print(f"warning:    {threads} threads exceed the {capacity} hashing slots; the extra calls are "
+                  f"rejected with HashingBusy and reported separately")
+        stored_hash = credentials.hash_password(args.password)
+        call = lambda: _local_call(stored_hash, args.password)
+
+    run(call, threads, args.seconds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Rate limiter latency check.
+
+Times ratelimit.check() with the in-memory backend while a large number of
+distinct keys are active (as with per-IP /login and /register keys from many
+client addresses), and fails if the p99 is over budget:
+
+    python bench_ratelimit.py --keys 50000 --calls 200000 --budget-us 50
+
+Set RATE_LIMIT_BACKEND=redis to time the Redis backend instead; expect one
+network round-trip per call there.
+"""
+import argparse
+import os
+import sys
+import time
+
+import ratelimit
+
+
+def measure(keys, calls):
+    # A generous limit so every key stays active and nothing is throttled
+    timings = []
+    for i in range(calls):
+        key = f'ip:login:client-{i % keys}'
+        start = time.perf_counter()
+        ratelimit.check(key, 'login', per_minute=60, burst=1000000)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--keys', type=int, default=50000)
+    parser.add_argument('--calls', type=int, default=200000)
+    parser.add_argument('--budget-us', type=float, default=float(os.getenv('RATE_LIMIT_BUDGET_US', '50')))
+    args = parser.parse_args()
+
+    timings = measure(args.keys, args.calls)
+    p50, p99 = timings[len(timings) // 2] * 1e6, timings[int(len(timings) * 0.99) - 1] * 1e6
+    print(f"backend:  {ratelimit.RATE_LIMIT_BACKEND} ({args.keys} active keys, {args.calls} calls)")
+    print(f"p50:      {p50:.1f} us")
+    print(f"p99:      {p99:.1f} us (budget {args.budget_us:.0f} us)")
+    print(f"max:      {timings[-1] * 1e6:.1f} us")
+
+    if p99 > args.budget_us:
+        print("FAIL: check() is over budget")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
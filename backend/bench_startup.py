@@ -0,0 +1,65 @@
+"""Startup regression check.
+
+Runs `python -X importtime -c "import app"` in a fresh interpreter with the
+schema check disabled, prints the slowest imports and fails if the total import
+time exceeds the budget or a module that must stay lazy was imported:
+
+    python bench_startup.py --budget-ms 800 --top 15
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# Modules that should only be imported on first use, never when the app loads
+LAZY_MODULES = ('google.generativeai', 'grpc', 'redis')
+
+
+def measure_imports(target):
+    env = dict(os.environ, SKIP_SCHEMA_CHECK='true')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {target}'],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stderr[-2000:])
+        sys.exit(result.returncode)
+
+    # Lines look like: "import time:  self [us] | cumulative | imported package"
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, self_us, cumulative_us, name = [part.strip() for part in line.replace('import time:', '|', 1).split('|')]
+        imports.append((name.strip(), int(self_us), int(cumulative_us)))
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', default='app')
+    parser.add_argument('--budget-ms', type=float, default=float(os.getenv('IMPORT_BUDGET_MS', '800')))
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    imports = measure_imports(args.target)
+    total_ms = sum(self_us for _, self_us, _ in imports) / 1000
+
+    print(f"Slowest imports (cumulative) for `import {args.target}`:")
+    for name, _, cumulative_us in sorted(imports, key=lambda item: item[2], reverse=True)[:args.top]:
+        print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+    print(f"Total: {total_ms:.1f} ms (budget {args.budget_ms:.0f} ms)")
+
+    failed = False
+    eager = sorted({name for name, _, _ in imports if name.startswith(LAZY_MODULES)})
+    if eager:
+        print("FAIL: these modules must be imported lazily: " + ", ".join(eager))
+        failed = True
+    if total_ms > args.budget_ms:
+        print("FAIL: import time is over budget")
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
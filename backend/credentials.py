@@ -0,0 +1,142 @@
+"""Password hashing for /register and /login.
+
+Hashing is CPU-bound, so it runs on a small dedicated thread pool
+(PASSWORD_HASH_WORKERS threads plus PASSWORD_HASH_QUEUE waiting jobs) instead
+of in every request thread at once. When the pool is full, new requests do not
+wait for a slot: they fail immediately with HashingBusy (503 + Retry-After).
+
+This only protects the rest of the API when request threads outnumber hashing
+slots, which is why gunicorn.conf.py runs gthread workers with several threads
+each. During a login storm at most a few threads per worker are tied up in
+hashing, and the others keep serving API requests.
+
+The algorithm and cost are configured from the environment. When a user logs
+in with a hash made under older settings, verify_password returns a fresh hash
+so the caller can store it (rehash-on-login).
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from werkzeug.security import generate_password_hash, check_password_hash
+
+try:
+    from argon2 import PasswordHasher
+    from argon2.exceptions import VerificationError, InvalidHashError
+except ImportError:  # argon2-cffi is only needed when PASSWORD_HASH_METHOD=argon2
+    PasswordHasher = None
+
+load_dotenv()
+
+# Hashing configuration
+HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt').lower()  # argon2 | scrypt | pbkdf2
+PBKDF2_ITERATIONS = int(os.getenv('PASSWORD_PBKDF2_ITERATIONS', '600000'))
+SCRYPT_N = int(os.getenv('PASSWORD_SCRYPT_N', '32768'))
+SCRYPT_R = int(os.getenv('PASSWORD_SCRYPT_R', '8'))
+SCRYPT_P = int(os.getenv('PASSWORD_SCRYPT_P', '1'))
+ARGON2_TIME_COST = int(os.getenv('PASSWORD_ARGON2_TIME_COST', '3'))
+ARGON2_MEMORY_COST = int(os.getenv('PASSWORD_ARGON2_MEMORY_COST', '65536'))  # KiB
+ARGON2_PARALLELISM = int(os.getenv('PASSWORD_ARGON2_PARALLELISM', '4'))
+
+# Executor configuration
+HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', '2'))
+HASH_QUEUE_SIZE = int(os.getenv('PASSWORD_HASH_QUEUE', '2'))
+
+if HASH_METHOD not in ('argon2', 'scrypt', 'pbkdf2'):
+    raise ValueError(f"Unsupported PASSWORD_HASH_METHOD: {HASH_METHOD}")
+if HASH_METHOD == 'argon2' and PasswordHasher is None:
+    raise ImportError("PASSWORD_HASH_METHOD=argon2 requires the argon2-cffi package")
+
+
+class HashingBusy(Exception):
+    """Raised when every hashing worker and queue slot is taken."""
+
+
+def _werkzeug_method():
+    """Full werkzeug method string, so stored hashes can be compared against it."""
+    if HASH_METHOD == 'pbkdf2':
+        return f"pbkdf2:sha256:{PBKDF2_ITERATIONS}"
+    return f"scrypt:{SCRYPT_N}:{SCRYPT_R}:{SCRYPT_P}"
+
+
+_argon2_hasher = None
+
+def _argon2():
+    global _argon2_hasher
+    if _argon2_hasher is None:
+        _argon2_hasher = PasswordHasher(time_cost=ARGON2_TIME_COST,
+                                        memory_cost=ARGON2_MEMORY_COST,
+                                        parallelism=ARGON2_PARALLELISM)
+    return _argon2_hasher
+
+
+def _hash(password):
+    if HASH_METHOD == 'argon2':
+        return _argon2().hash(password)
+    return generate_password_hash(password, method=_werkzeug_method())
+
+
+def _check(stored_hash, password):
+    if stored_hash.startswith('$argon2'):
+        if PasswordHasher is None:
+            print("Cannot verify argon2 hash: argon2-cffi is not installed")
+            return False
+        try:
+            return _argon2().verify(stored_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+    return check_password_hash(stored_hash, password)
+
+
+def needs_rehash(stored_hash):
+    """True if the stored hash was made with a different algorithm or cost."""
+    if HASH_METHOD == 'argon2':
+        return not stored_hash.startswith('$argon2') or _argon2().check_needs_rehash(stored_hash)
+    return stored_hash.split('$', 1)[0] != _werkzeug_method()
+
+
+def _verify_and_upgrade(stored_hash, password):
+    if not _check(stored_hash, password):
+        return False, None
+    if needs_rehash(stored_hash):
+        return True, _hash(password)
+    return True, None
+
+
+# Executor is created lazily so it is never started before a fork (gunicorn --preload)
+_executor = None
+_slots = None
+_executor_lock = threading.Lock()
+
+def _run(fn, *args):
+    global _executor, _slots
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _slots = threading.BoundedSemaphore(HASH_WORKERS + HASH_QUEUE_SIZE)
+                _executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='password-hash')
+
+    # Never park a request thread waiting for a slot; shed the load instead
+    if not _slots.acquire(blocking=False):
+        raise HashingBusy("Password hashing is busy, try again shortly")
+    try:
+        future = _executor.submit(fn, *args)
+    except Exception:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    return future.result()
+
+
+def hash_password(password):
+    """Hash a new password with the configured algorithm and cost."""
+    return _run(_hash, password)
+
+
+def verify_password(stored_hash, password):
+    """Check a password against its stored hash.
+
+    Returns (ok, new_hash). new_hash is set only when the password is correct and
+    the stored hash should be replaced because the configured parameters changed.
+    """
+    return _run(_verify_and_upgrade, stored_hash, password)
@@ -3,10 +3,40 @@ import psycopg2.extras
 import os
 from datetime import datetime
 import json
+import threading
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Per-request query counting for load tests (see instrumentation.py)
+DB_QUERY_COUNTING = os.getenv('DB_QUERY_COUNTING', 'false').lower() == 'true'
+_query_counter = threading.local()
+_counting_cursor_classes = {}
+
+def reset_query_count():
+    _query_counter.count = 0
+
+def get_query_count():
+    return getattr(_query_counter, 'count', 0)
+
+def _counting_cursor_class(base):
+    """Subclass of `base` that counts execute() calls on the current thread"""
+    cls = _counting_cursor_classes.get(base)
+    if cls is None:
+        class CountingCursor(base):
+            def execute(self, query, vars=None):
+                _query_counter.count = get_query_count() + 1
+                return super().execute(query, vars)
+        cls = _counting_cursor_classes[base] = CountingCursor
+    return cls
+
+class CountingConnection(psycopg2.extensions.connection):
+    def cursor(self, *args, **kwargs):
+        kwargs['cursor_factory'] = _counting_cursor_class(kwargs.get('cursor_factory') or psycopg2.extensions.cursor)
+        return super().cursor(*args, **kwargs)
+
+_connection_factory = CountingConnection if DB_QUERY_COUNTING else None
+
 def get_db_connection():
     """Get PostgreSQL database connection"""
     try:
@@ -17,13 +47,14 @@ def get_db_connection():
                 port=os.getenv('DB_PORT', '5432'),
                 database=os.getenv('DB_NAME', 'education_chatbot'),
                 user=os.getenv('DB_USER', 'postgres'),
-                password=os.getenv('DB_PASSWORD')
+                password=os.getenv('DB_PASSWORD'),
+                connection_factory=_connection_factory
             )
         else:
             # Fallback to DATABASE_URL (for production/Heroku)
             database_url = os.getenv('DATABASE_URL')
             if database_url:
-                conn = psycopg2.connect(database_url)
+                conn = psycopg2.connect(database_url, connection_factory=_connection_factory)
             else:
                 # Default connection
                 conn = psycopg2.connect(
@@ -31,7 +62,8 @@ def get_db_connection():
                     port='5432',
                     database='education_chatbot',
                     user='postgres',
-                    password='password'
+                    password='password',
+                    connection_factory=_connection_factory
                 )
         return conn
     except psycopg2.Error as e:
@@ -70,6 +102,12 @@ def create_tables():
         )
         ''')
 
+        # Rows logged together for one /generate_set worksheet share a set_id,
+        # so replay.py can rebuild the single request that produced them
+        cursor.execute('''
+        ALTER TABLE interactions ADD COLUMN IF NOT EXISTS set_id VARCHAR(32)
+        ''')
+
         # Create table for chat history
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS chat_history (
@@ -81,6 +119,84 @@ def create_tables():
         )
         ''')
 
+        # Full-text search over chat titles and message text. The column is
+        # generated, so Postgres keeps it (and its GIN index) current on every
+        # INSERT/UPDATE. English stemming plus the 'simple' config for Hindi.
+        cursor.execute('''
+        ALTER TABLE chat_history ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+            setweight(jsonb_to_tsvector('english', coalesce(jsonb_path_query_array(messages, '$[*].text'), '[]'), '["string"]'), 'B') ||
+            setweight(jsonb_to_tsvector('simple', coalesce(jsonb_path_query_array(messages, '$[*].text'), '[]'), '["string"]'), 'B')
+        ) STORED
+        ''')
+
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_history_search ON chat_history USING GIN (search_vector)
+        ''')
+
+        # Daily LLM token usage rollups (see usage.py)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS llm_usage_daily (
+            day DATE NOT NULL,
+            endpoint VARCHAR(100) NOT NULL,
+            feature VARCHAR(100) NOT NULL,
+            user_id INTEGER NOT NULL,
+            calls INTEGER NOT NULL DEFAULT 0,
+            prompt_tokens BIGINT NOT NULL DEFAULT 0,
+            output_tokens BIGINT NOT NULL DEFAULT 0,
+            cached_tokens BIGINT NOT NULL DEFAULT 0,
+            latency_ms DOUBLE PRECISION NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, endpoint, feature, user_id)
+        )
+        ''')
+
+        # Curated question bank (see question_bank.py)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS question_bank (
+            id SERIAL PRIMARY KEY,
+            grade VARCHAR(50) NOT NULL,
+            subject VARCHAR(100) NOT NULL,
+            topic VARCHAR(100) NOT NULL DEFAULT '',
+            difficulty SMALLINT NOT NULL DEFAULT 1,
+            language VARCHAR(20) NOT NULL DEFAULT 'English',
+            question TEXT NOT NULL,
+            answer TEXT,
+            source VARCHAR(255),
+            random_key DOUBLE PRECISION NOT NULL DEFAULT random(),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+
+        cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_question_bank_unique
+        ON question_bank (grade, subject, language, md5(question))
+        ''')
+
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_question_bank_sample
+        ON question_bank (grade, subject, language, difficulty, random_key)
+        ''')
+
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_question_bank_sample_topic
+        ON question_bank (grade, subject, language, difficulty, topic, random_key)
+        ''')
+
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS question_bank_seen (
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            question_id INTEGER REFERENCES question_bank(id) ON DELETE CASCADE,
+            seen_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, question_id)
+        )
+        ''')
+
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_history_user_timestamp ON chat_history (user_id, timestamp DESC)
+        ''')
+
         conn.commit()
         print("Database tables created successfully!")
 
@@ -92,6 +208,70 @@ def create_tables():
         cursor.close()
         conn.close()
 
+_schema_checked = False
+
+def ensure_schema():
+    """Run create_tables() once per process.
+
+    With gunicorn --preload the app is built once in the master, so this is a
+    single round-trip per deploy rather than one per worker. Set
+    SKIP_SCHEMA_CHECK=true to skip it entirely (e.g. when benchmarking startup).
+    """
+    global _schema_checked
+    if _schema_checked or os.getenv('SKIP_SCHEMA_CHECK', 'false').lower() == 'true':
+        return
+    create_tables()
+    _schema_checked = True
+
+def create_user(name, email, password_hash):
+    """Insert a new user, relying on the UNIQUE email constraint.
+
+    Returns the new user ID, or None if the email is already registered.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute('''
+        INSERT INTO users (name, email, password)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (email) DO NOTHING
+        RETURNING id
+        ''', (name, email, password_hash))
+
+        row = cursor.fetchone()
+        conn.commit()
+
+        return row[0] if row else None
+
+    except psycopg2.Error as e:
+        print(f"Error creating user: {e}")
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+def update_user_password(user_id, password_hash):
+    """Replace a user's stored password hash (used for rehash-on-login)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute('''
+        UPDATE users SET password = %s WHERE id = %s
+        ''', (password_hash, user_id))
+
+        conn.commit()
+
+    except psycopg2.Error as e:
+        print(f"Error updating user password: {e}")
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
 def log_interaction(grade, subject, question, answer, feedback, topic=None):
     """Log user interaction to PostgreSQL database"""
     conn = get_db_connection()
@@ -113,6 +293,35 @@ def log_interaction(grade, subject, question, answer, feedback, topic=None):
         cursor.close()
         conn.close()
 
+def log_interactions(rows):
+    """Log several interactions in one round-trip.
+
+    `rows` is a list of dicts with the same keys as log_interaction's arguments,
+    plus an optional 'set_id' grouping rows that came from one request.
+    """
+    if not rows:
+        return
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    try:
+        psycopg2.extras.execute_values(cursor, '''
+        INSERT INTO interactions (grade, subject, topic, question, answer, feedback, set_id)
+        VALUES %s
+        ''', [(row.get('grade'), row.get('subject'), row.get('topic'), row.get('question'),
+               row.get('answer', ''), row.get('feedback', ''), row.get('set_id')) for row in rows])
+
+        conn.commit()
+
+    except psycopg2.Error as e:
+        print(f"Error logging interactions: {e}")
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
 def save_chat_history(user_id, title, messages):
     """Save chat history to PostgreSQL database"""
     conn = get_db_connection()
@@ -138,21 +347,28 @@ def save_chat_history(user_id, title, messages):
         cursor.close()
         conn.close()
 
-def get_user_chat_history(user_id):
-    """Get all chat history for a specific user from PostgreSQL"""
+# JSON text builders: Postgres serializes the rows, so the JSONB messages are never
+# decoded into Python objects. Timestamps use the same HTTP-date format as jsonify.
+CHAT_JSON_FIELDS = '''
+    'id', id,
+    'title', title,
+    'timestamp', to_char(timestamp, 'Dy, DD Mon YYYY HH24:MI:SS "GMT"'),
+    'messages', messages
+'''
+
+def get_user_chat_history_json(user_id):
+    """Get all chat history for a user as a ready-to-send JSON array string"""
     conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cursor = conn.cursor()
 
     try:
-        cursor.execute('''
-        SELECT id, title, timestamp, messages
+        cursor.execute(f'''
+        SELECT coalesce(json_agg(json_build_object({CHAT_JSON_FIELDS}) ORDER BY timestamp DESC), '[]')::text
         FROM chat_history
         WHERE user_id = %s
-        ORDER BY timestamp DESC
         ''', (user_id,))
 
-        history = [dict(row) for row in cursor.fetchall()]
-        return history
+        return cursor.fetchone()[0]
 
     except psycopg2.Error as e:
         print(f"Error getting user chat history: {e}")
@@ -161,26 +377,100 @@ def get_user_chat_history(user_id):
         cursor.close()
         conn.close()
 
-def get_chat_by_id(history_id):
-    """Get specific chat by ID from PostgreSQL"""
+def get_chat_json(history_id, user_id):
+    """Get one of a user's chats as a JSON object string, or None if it isn't theirs"""
     conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cursor = conn.cursor()
 
     try:
-        cursor.execute('''
-        SELECT id, user_id, title, timestamp, messages
+        cursor.execute(f'''
+        SELECT json_build_object('user_id', user_id, {CHAT_JSON_FIELDS})::text
         FROM chat_history
-        WHERE id = %s
+        WHERE id = %s AND user_id = %s
+        ''', (history_id, user_id))
+
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    except psycopg2.Error as e:
+        print(f"Error getting chat by ID: {e}")
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+def get_chat_owner(history_id):
+    """Get the user ID that owns a chat without loading its messages"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute('''
+        SELECT user_id FROM chat_history WHERE id = %s
         ''', (history_id,))
 
-        chat = cursor.fetchone()
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    except psycopg2.Error as e:
+        print(f"Error getting chat owner: {e}")
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+def search_chat_history(user_id, query, limit=20, after=None):
+    """Full-text search over a user's chats, best matches first.
+
+    Returns (results, next_cursor). `after` is the cursor from the previous
+    page: a (rank, id) pair, so pages are fetched by keyset rather than OFFSET.
+    Snippets are only built for the rows on the requested page. They are
+    HTML-safe: the chat text is escaped (&, <, >) before ts_headline wraps the
+    matches in <mark>...</mark>, so those are the only tags in a snippet.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+    keyset = ''
+    params = {'user_id': user_id, 'q': query, 'limit': limit}
+    if after is not None:
+        keyset = 'AND (ts_rank_cd(c.search_vector, q.query)::real, c.id) < (%(after_rank)s::real, %(after_id)s)'
+        params['after_rank'], params['after_id'] = after
 
-        if chat:
-            return dict(chat)
-        return None
+    try:
+        cursor.execute(f'''
+        WITH q AS (
+            SELECT websearch_to_tsquery('english', %(q)s) || websearch_to_tsquery('simple', %(q)s) AS query
+        ),
+        page AS (
+            SELECT c.id, c.title, c.timestamp, c.messages,
+                   ts_rank_cd(c.search_vector, q.query)::real AS rank
+            FROM chat_history c, q
+            WHERE c.user_id = %(user_id)s AND c.search_vector @@ q.query {keyset}
+            ORDER BY rank DESC, c.id DESC
+            LIMIT %(limit)s
+        )
+        SELECT page.id, page.title, page.timestamp, page.rank,
+               ts_headline('english',
+                           replace(replace(replace(
+                               coalesce((SELECT string_agg(m->>'text', ' ')
+                                         FROM jsonb_array_elements(CASE WHEN jsonb_typeof(page.messages) = 'array'
+                                                                        THEN page.messages ELSE '[]' END) m), ''),
+                               '&', '&amp;'), '<', '&lt;'), '>', '&gt;'),
+                           q.query,
+                           'StartSel=<mark>, StopSel=</mark>, MaxFragments=2, MaxWords=20, MinWords=5') AS snippet
+        FROM page, q
+        ORDER BY page.rank DESC, page.id DESC
+        ''', params)
+
+        results = [dict(row) for row in cursor.fetchall()]
+        next_cursor = None
+        if len(results) == limit:
+            next_cursor = f"{results[-1]['rank']!r}:{results[-1]['id']}"
+        return results, next_cursor
 
     except psycopg2.Error as e:
-        print(f"Error getting chat by ID: {e}")
+        print(f"Error searching chat history: {e}")
         raise
     finally:
         cursor.close()
@@ -1,11 +1,48 @@
 import os
 from dotenv import load_dotenv
-import google.generativeai as genai
 import time
 import re
+import json
+import difflib
+import usage
 
 load_dotenv()
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+
+# google.generativeai is slow to import and its gRPC transport is not fork-safe,
+# so it is imported and configured on first use inside each worker.
+_genai = None
+
+def _get_model(name='gemini-1.5-flash'):
+    global _genai
+    if os.getenv('LLM_STUB', 'false').lower() == 'true':
+        from llm_stub import StubModel
+        return StubModel(name)
+    if _genai is None:
+        import google.generativeai as genai
+        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+        _genai = genai
+    return _genai.GenerativeModel(name)
+
+def _generate(feature, prompt):
+    """Call the model once, within the feature's output budget, and record its token usage."""
+    start = time.perf_counter()
+    response = _get_model().generate_content(prompt, generation_config=usage.generation_config(feature))
+    usage.record(feature, getattr(response, 'usage_metadata', None), time.perf_counter() - start)
+    return response.text
+
+def _generate_stream(feature, prompt):
+    """Streaming version of _generate. Usage is recorded even if the caller stops early."""
+    start = time.perf_counter()
+    usage_metadata = None
+    response = _get_model().generate_content(prompt, stream=True, generation_config=usage.generation_config(feature))
+    try:
+        for chunk in response:
+            # Each chunk carries the running totals; the last one has the final counts
+            usage_metadata = getattr(chunk, 'usage_metadata', None) or usage_metadata
+            if chunk.text:
+                yield chunk.text
+    finally:
+        usage.record(feature, usage_metadata, time.perf_counter() - start)
 
 def extract_number(user_input):
     """Extract the first number (integer or decimal) from the input string."""
@@ -40,17 +77,13 @@ def generate_question(grade, subject, topic=None, difficulty=1, language="Englis
     else:
         prompt = f"""You are a Math Learning Assistant. Generate a Class {grade} level {subject} question.\n\nThe question should be {diff_text} difficulty for this grade. Don't give the answer yet, just the question.\n\n{lang_instruction}\n\nThe question should be clearly mathematical in nature and suitable for educational practice."""
 
-    model = genai.GenerativeModel('gemini-1.5-flash')
-    response = model.generate_content(prompt)
-    return response.text
+    return _generate('generate_question', prompt)
 
 def evaluate_answer(question, user_answer, language="English"):
     lang_instruction = "Respond in English." if language == "English" else "उत्तर हिंदी में दें।"
     prompt = f"""Here is the question: \"{question}\"\nThe student answered: \"{user_answer}\"\n\nEvaluate the answer using this format:\n- Start with \"Correct!\" or \"Incorrect.\"\n- If incorrect, say \"That's okay, let's work through it step by step.\"\n- Break your explanation into clear paragraphs with line breaks\n- Use step-by-step format with proper spacing\n- End with a clear summary using ✅ symbol\n- Be encouraging and supportive\n\n{lang_instruction}\n\nFormat your response with proper line breaks between paragraphs, not as one long block of text."""
 
-    model = genai.GenerativeModel('gemini-1.5-flash')
-    response = model.generate_content(prompt)
-    return response.text
+    return _generate('evaluate_answer', prompt)
 
 def answer_direct_question(question, grade, subject, topic=None, language="English"):
     # Quick check for obviously non-math inputs
@@ -68,9 +101,7 @@ def answer_direct_question(question, grade, subject, topic=None, language="Engli
 
     prompt = f"""{context}.\n\nThe student asks: \"{question}\"\n\nIMPORTANT: You are ONLY a Math Learning Assistant. Follow these rules STRICTLY:\n\n1. FIRST, check if the question is a proper mathematics question. A math question should:\n   - Ask about mathematical concepts, formulas, or calculations\n   - Contain mathematical terms or symbols\n   - Be a complete, meaningful question about math\n   - NOT be random letters, single words, or nonsensical text\n\n2. If the input is NOT a proper math question (including random text like \"ui\", \"aap\", \"hello\", single letters, incomplete sentences, non-math topics like history/science/literature, personal questions, general chat, etc.), respond EXACTLY like this:\n\n\"Sorry Sir, this is not a math question. I am available here to provide math evaluation. Would you like to ask a math question?\n\nHere's how we can proceed:\n• I can generate practice questions for your grade level\n• I can help solve math problems step-by-step\n• I can explain math concepts and formulas\n• I can evaluate your answers and provide feedback\n\nWhat math topic would you like to explore? (Algebra, Geometry, Calculus, Statistics, Arithmetic)\"\n\n3. If it IS a math question, provide a clear, step-by-step explanation using this format:\n- Break your response into clear paragraphs with line breaks\n- Use step-by-step approach with proper spacing between steps\n- If it's a calculation, show each step on a new line\n- Use clear headings or bullet points when helpful\n- End with a clear summary using ✅ symbol\n- Keep explanations appropriate for their grade level\n- Use examples when helpful\n\n{lang_instruction}\n\nFormat your response with proper line breaks between paragraphs, not as one long block of text."""
 
-    model = genai.GenerativeModel('gemini-1.5-flash')
-    response = model.generate_content(prompt)
-    return response.text
+    return _generate('answer_direct_question', prompt)
 
 # Streaming versions of the functions
 
@@ -86,20 +117,12 @@ def generate_question_stream(grade, subject, topic=None, difficulty=1, language=
         prompt = f"Ask a Class {grade} level {subject} question about {topic}. The question should be {diff_text} difficulty for this grade. Don't give the answer yet, just the question. {lang_instruction}"
     else:
         prompt = f"Ask a Class {grade} level {subject} question. The question should be {diff_text} difficulty for this grade. Don't give the answer yet, just the question. {lang_instruction}"
-    model = genai.GenerativeModel('gemini-1.5-flash')
-    response = model.generate_content(prompt, stream=True)
-    for chunk in response:
-        if chunk.text:
-            yield chunk.text
+    yield from _generate_stream('generate_question', prompt)
 
 def evaluate_answer_stream(question, user_answer, language="English"):
     lang_instruction = "Respond in English." if language == "English" else "उत्तर हिंदी में दें।"
     prompt = f"""Here is the question: \"{question}\"\nThe student answered: \"{user_answer}\"\n\nEvaluate the answer using this format:\n- Start with \"Correct!\" or \"Incorrect.\"\n- If incorrect, say \"That's okay, let's work through it step by step.\"\n- Break your explanation into clear paragraphs with line breaks\n- Use step-by-step format with proper spacing\n- End with a clear summary using ✅ symbol\n- Be encouraging and supportive\n\n{lang_instruction}\n\nFormat your response with proper line breaks between paragraphs, not as one long block of text."""
-    model = genai.GenerativeModel('gemini-1.5-flash')
-    response = model.generate_content(prompt, stream=True)
-    for chunk in response:
-        if chunk.text:
-            yield chunk.text
+    yield from _generate_stream('evaluate_answer', prompt)
 
 def answer_direct_question_stream(question, grade, subject, topic=None, language="English"):
     question_clean = question.strip().lower()
@@ -114,8 +137,116 @@ def answer_direct_question_stream(question, grade, subject, topic=None, language
         context += f" specifically about {topic}"
     lang_instruction = "Respond in English." if language == "English" else "उत्तर हिंदी में दें।"
     prompt = f"""{context}.\n\nThe student asks: \"{question}\"\n\nIMPORTANT: You are ONLY a Math Learning Assistant. Follow these rules STRICTLY:\n\n1. FIRST, check if the question is a proper mathematics question. A math question should:\n   - Ask about mathematical concepts, formulas, or calculations\n   - Contain mathematical terms or symbols\n   - Be a complete, meaningful question about math\n   - NOT be random letters, single words, or nonsensical text\n\n2. If the input is NOT a proper math question (including random text like \"ui\", \"aap\", \"hello\", single letters, incomplete sentences, non-math topics like history/science/literature, personal questions, general chat, etc.), respond EXACTLY like this:\n\n\"Sorry Sir, this is not a math question. I am available here to provide math evaluation. Would you like to ask a math question?\n\nHere's how we can proceed:\n• I can generate practice questions for your grade level\n• I can help solve math problems step-by-step\n• I can explain math concepts and formulas\n• I can evaluate your answers and provide feedback\n\nWhat math topic would you like to explore? (Algebra, Geometry, Calculus, Statistics, Arithmetic)\"\n\n3. If it IS a math question, provide a clear, step-by-step explanation using this format:\n- Break your response into clear paragraphs with line breaks\n- Use step-by-step approach with proper spacing between steps\n- If it's a calculation, show each step on a new line\n- Use clear headings or bullet points when helpful\n- End with a clear summary using ✅ symbol\n- Keep explanations appropriate for their grade level\n- Use examples when helpful\n\n{lang_instruction}\n\nFormat your response with proper line breaks between paragraphs, not as one long block of text."""
-    model = genai.GenerativeModel('gemini-1.5-flash')
-    response = model.generate_content(prompt, stream=True)
-    for chunk in response:
-        if chunk.text:
-            yield chunk.text
+    yield from _generate_stream('answer_direct_question', prompt)
+
+# Worksheet generation: many questions from a single model call
+
+MAX_SET_SIZE = 50
+DIFFICULTY_LABELS = {1: "easy", 2: "medium", 3: "hard"}
+
+def _normalize_question(text):
+    """Lower-case and strip punctuation/whitespace so near-identical questions compare equal."""
+    return re.sub(r'[^\w]+', ' ', text.lower()).strip()
+
+def _is_near_duplicate(normalized, seen, threshold=0.9):
+    """Check a normalized question against the ones already accepted for this set."""
+    for other in seen:
+        if normalized == other:
+            return True
+        if difflib.SequenceMatcher(None, normalized, other).ratio() >= threshold:
+            return True
+    return False
+
+def _parse_question_line(line, default_topic=None):
+    """Parse one JSON line of model output into a question dict, or None if it is not valid."""
+    line = line.strip().rstrip(',')
+    if not line.startswith('{'):
+        return None
+    try:
+        item = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(item, dict):
+        return None
+
+    question = str(item.get("question", "")).strip()
+    if len(question) < 10:
+        return None
+
+    difficulty = str(item.get("difficulty", "")).strip().lower()
+    if difficulty not in DIFFICULTY_LABELS.values():
+        difficulty = "medium"
+
+    return {
+        "question": question,
+        "topic": str(item.get("topic") or default_topic or "").strip() or None,
+        "difficulty": difficulty
+    }
+
+def _question_set_prompt(grade, subject, count, topics=None, difficulty=None, language="English", avoid=None):
+    if difficulty in DIFFICULTY_LABELS:
+        diff_text = f"All questions should be {DIFFICULTY_LABELS[difficulty]} difficulty for this grade."
+    else:
+        diff_text = "Use a mix of easy, medium and hard difficulty for this grade."
+
+    if topics:
+        topic_text = "Spread the questions across these topics: " + ", ".join(topics) + "."
+    else:
+        topic_text = f"Cover a variety of Class {grade} {subject} topics."
+
+    lang_instruction = "Write the questions in English." if language == "English" else "सवाल हिंदी में लिखें।"
+
+    prompt = f"""You are a Math Learning Assistant. Generate {count} different Class {grade} level {subject} practice questions for a worksheet.\n\n{diff_text}\n{topic_text}\n\nDon't give the answers, just the questions. {lang_instruction}\n\nOutput format: exactly one JSON object per line, with no numbering, no markdown and no other text:\n{{"question": "...", "topic": "...", "difficulty": "easy|medium|hard"}}"""
+
+    if avoid:
+        prompt += "\n\nDo not repeat or rephrase any of these questions:\n" + "\n".join(f"- {q}" for q in avoid)
+
+    return prompt
+
+def generate_question_set_stream(grade, subject, count=10, topics=None, difficulty=None, language="English", max_rounds=3):
+    """Yield up to `count` validated, de-duplicated questions as soon as each one is parsed.
+
+    A single model call is asked for the whole set. Lines that fail validation or
+    duplicate an earlier question are dropped, and any shortfall is topped up with
+    a follow-up call (at most `max_rounds` calls in total).
+    """
+    count = max(1, min(int(count), MAX_SET_SIZE))
+    default_topic = topics[0] if topics and len(topics) == 1 else None
+    accepted = []
+    seen = []
+
+    def accept(line):
+        item = _parse_question_line(line, default_topic)
+        if item is None:
+            return None
+        normalized = _normalize_question(item["question"])
+        if _is_near_duplicate(normalized, seen):
+            return None
+        seen.append(normalized)
+        accepted.append(item)
+        return item
+
+    for _ in range(max_rounds):
+        remaining = count - len(accepted)
+        if remaining <= 0:
+            return
+
+        prompt = _question_set_prompt(grade, subject, remaining, topics, difficulty, language,
+                                      avoid=[item["question"] for item in accepted])
+        response = _generate_stream('generate_question_set', prompt)
+
+        buffer = ""
+        for text in response:
+            buffer += text
+            *lines, buffer = buffer.split("\n")
+            for line in lines:
+                item = accept(line)
+                if item:
+                    yield item
+                    if len(accepted) >= count:
+                        return
+
+        # The last line may arrive without a trailing newline
+        item = accept(buffer)
+        if item:
+            yield item
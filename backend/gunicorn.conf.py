@@ -0,0 +1,23 @@
+"""Gunicorn settings, picked up automatically when gunicorn runs from this directory.
+
+The app is built once in the master (schema check included) and forked into
+the workers, which share its memory copy-on-write. Clients that hold threads,
+sockets or gRPC channels (Gemini, the hashing pool, Redis) are created lazily
+inside each worker, so nothing unsafe is inherited across the fork.
+
+Workers are threaded (gthread) so that a worker busy with password hashing
+(capped by the pool in credentials.py) or a long LLM stream still has free
+threads for other API requests.
+"""
+import gc
+import os
+
+preload_app = True
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+
+
+def when_ready(server):
+    # Move everything loaded so far out of the GC's reach, so collections in the
+    # workers don't write to (and un-share) the preloaded pages
+    gc.freeze()
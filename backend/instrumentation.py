@@ -0,0 +1,78 @@
+"""Opt-in request instrumentation for load testing and traffic capture.
+
+Nothing is registered unless one of these is set:
+
+- CAPTURE_REQUESTS_FILE=path appends one JSON line per API request (time,
+  path, status, duration, JSON body and response length) for
+  `replay.py export --from-log`. Bodies of auth and admin requests are never
+  written. The response length is the number of text characters in a
+  non-streamed JSON response, the same measure the stub model paces.
+- DB_QUERY_COUNTING=true adds an X-DB-Queries header with the number of SQL
+  statements the request ran before its response was returned.
+- LLM_STUB=true takes the stub model's response length from the
+  X-Stub-Response-Length header (see llm_stub.py).
+"""
+import json
+import os
+import time
+from flask import request, g
+from db import DB_QUERY_COUNTING, reset_query_count, get_query_count
+from llm_stub import response_length
+
+CAPTURE_REQUESTS_FILE = os.getenv('CAPTURE_REQUESTS_FILE')
+LLM_STUB = os.getenv('LLM_STUB', 'false').lower() == 'true'
+PRIVATE_PATHS = ('/login', '/register', '/admin')
+
+
+def _before():
+    g.request_started = time.perf_counter()
+    if DB_QUERY_COUNTING:
+        reset_query_count()
+    if LLM_STUB:
+        length = request.headers.get('X-Stub-Response-Length', '')
+        response_length.set(int(length) if length.isdigit() else None)
+
+
+def _response_length(response):
+    """Characters of text in a non-streamed JSON response, or None."""
+    if response.is_streamed or not response.is_json or 'Content-Encoding' in response.headers:
+        return None
+    data = response.get_json(silent=True)
+    if not isinstance(data, dict):
+        return None
+    return sum(len(value) for value in data.values() if isinstance(value, str))
+
+
+def _capture(response):
+    body = None
+    if not request.path.startswith(PRIVATE_PATHS):
+        body = request.get_json(silent=True)
+    line = json.dumps({
+        'ts': time.time(),
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+        'duration_ms': round((time.perf_counter() - g.request_started) * 1000, 1),
+        'body': body,
+        'response_length': _response_length(response)
+    }, default=str)
+    # One short append per line, so lines from several workers don't interleave
+    with open(CAPTURE_REQUESTS_FILE, 'a', encoding='utf-8') as f:
+        f.write(line + '\n')
+
+
+def _after(response):
+    if DB_QUERY_COUNTING:
+        response.headers['X-DB-Queries'] = str(get_query_count())
+    if CAPTURE_REQUESTS_FILE and request.method != 'OPTIONS':
+        try:
+            _capture(response)
+        except OSError as e:
+            print(f"Error capturing request: {e}")
+    return response
+
+
+def init_app(app):
+    if CAPTURE_REQUESTS_FILE or DB_QUERY_COUNTING or LLM_STUB:
+        app.before_request(_before)
+        app.after_request(_after)
@@ -0,0 +1,90 @@
+"""Stand-in for the Gemini model, used for load tests and traffic replay.
+
+Enabled with LLM_STUB=true. The stub answers with filler text of a given
+length and paces it like a real model (first-token delay, then a steady
+character rate), so the backend sees realistic timing without spending quota.
+The length comes from the X-Stub-Response-Length request header set by
+replay.py, falling back to LLM_STUB_DEFAULT_LENGTH.
+"""
+import contextvars
+import json
+import os
+import random
+import re
+import time
+
+DEFAULT_LENGTH = int(os.getenv('LLM_STUB_DEFAULT_LENGTH', '600'))
+FIRST_TOKEN_SECONDS = float(os.getenv('LLM_STUB_FIRST_TOKEN_SECONDS', '0.5'))
+CHARS_PER_SECOND = float(os.getenv('LLM_STUB_CHARS_PER_SECOND', '400'))
+CHUNK_SIZE = 80
+
+_FILLER = ("Let's work through this step by step. First, write down what is given. "
+           "Next, apply the formula and simplify each side carefully. ")
+
+_VOCABULARY = ("area perimeter angle triangle circle radius square root fraction ratio "
+               "percentage equation polynomial factor sum product difference quotient "
+               "average median slope line volume cube prime multiple")
+
+# Set per request by the instrumentation hook
+response_length = contextvars.ContextVar('stub_response_length', default=None)
+
+
+class _Usage:
+    def __init__(self, prompt, text):
+        # Roughly four characters per token
+        self.prompt_token_count = len(prompt) // 4
+        self.candidates_token_count = len(text) // 4
+        self.cached_content_token_count = 0
+
+
+class _Chunk:
+    def __init__(self, text, usage_metadata=None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+def _filler_text(length):
+    return (_FILLER * (length // len(_FILLER) + 1))[:length]
+
+
+def _question_set_text(prompt):
+    # Worksheet prompts ask to "Generate N different ..." questions, one JSON object per line
+    match = re.search(r'Generate (\d+) ', prompt)
+    count = int(match.group(1)) if match else 10
+    lines = []
+    for i in range(count):
+        # Shuffle a vocabulary per question so the items don't look like near-duplicates
+        words = _VOCABULARY.split()
+        random.Random(i).shuffle(words)
+        question = f"Find the {' '.join(words[:10])} when x = {i + 2}?"
+        lines.append(json.dumps({"question": question, "topic": "Algebra", "difficulty": "easy"}))
+    return "\n".join(lines)
+
+
+class StubModel:
+    def __init__(self, name='stub'):
+        self.name = name
+
+    def _text_for(self, prompt):
+        length = response_length.get() or DEFAULT_LENGTH
+        if 'one JSON object per line' in prompt:
+            return _question_set_text(prompt)
+        return _filler_text(length)
+
+    def _stream(self, prompt, text):
+        time.sleep(FIRST_TOKEN_SECONDS)
+        for start in range(0, len(text), CHUNK_SIZE):
+            chunk = text[start:start + CHUNK_SIZE]
+            if start:
+                time.sleep(len(chunk) / CHARS_PER_SECOND)
+            last = start + CHUNK_SIZE >= len(text)
+            yield _Chunk(chunk, _Usage(prompt, text) if last else None)
+
+    def generate_content(self, prompt, stream=False, generation_config=None):
+        text = self._text_for(prompt)
+        if generation_config and generation_config.get('max_output_tokens'):
+            text = text[:generation_config['max_output_tokens'] * 4]
+        if stream:
+            return self._stream(prompt, text)
+        time.sleep(FIRST_TOKEN_SECONDS + len(text) / CHARS_PER_SECOND)
+        return _Chunk(text, _Usage(prompt, text))
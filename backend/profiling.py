@@ -0,0 +1,205 @@
+"""On-demand sampling profiler and slow-request stack capture.
+
+A background thread samples Python stacks with sys._current_frames() every
+PROFILE_INTERVAL_MS. It is only started when first needed, and no tracing
+hooks are installed, so request threads run at full speed while profiled.
+
+- Manual sessions (start_session) sample every thread in this worker process
+  for N seconds. With several gunicorn workers, only the worker that served
+  the start request is profiled.
+- With SLOW_REQUEST_PROFILE_MS set, the stacks of each in-flight request are
+  sampled and kept only if the request (including a streamed body) runs
+  longer than the threshold.
+
+Profiles are written to PROFILE_DIR as collapsed stacks (`.collapsed`, for
+flamegraph.pl / speedscope) and as speedscope JSON (`.speedscope.json`).
+"""
+import itertools
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from flask import g, request
+
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', '10'))
+PROFILE_MAX_SECONDS = int(os.getenv('PROFILE_MAX_SECONDS', '120'))
+PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', '200'))
+SLOW_REQUEST_PROFILE_MS = float(os.getenv('SLOW_REQUEST_PROFILE_MS', '0'))  # 0 disables
+
+_lock = threading.Lock()
+_session = None   # manual session: {'name', 'until', 'counts'}
+_tracked = {}     # thread ident -> Counter of stacks for in-flight requests
+_sampler = None
+_sequence = itertools.count(1)  # keeps slow-request filenames unique within a second
+
+
+def _collapse(frame):
+    """Render a frame chain root-first as 'func (file:line);func (file:line);...'"""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+def _sample_loop():
+    global _session
+    interval = PROFILE_INTERVAL_MS / 1000
+    me = threading.get_ident()
+    while True:
+        time.sleep(interval)
+        with _lock:
+            session = _session
+            tracked = list(_tracked.items())
+        if session is None and not tracked:
+            continue
+
+        # Stacks are rendered outside the lock; the counters are only touched under it,
+        # so finish() and _save never see a Counter that is still being updated
+        frames = sys._current_frames()
+        session_stacks = []
+        if session is not None:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            session_stacks = [f"{names.get(ident, ident)};{_collapse(frame)}"
+                              for ident, frame in frames.items() if ident != me]
+        tracked_stacks = [(ident, counts, _collapse(frames[ident])) for ident, counts in tracked if ident in frames]
+
+        finished = None
+        with _lock:
+            if session is not None and _session is session:
+                session['counts'].update(session_stacks)
+                if time.time() >= session['until']:
+                    _session = None
+                    finished = session
+            for ident, counts, stack in tracked_stacks:
+                # Skip requests that finished (or a new one reusing the thread) since the snapshot
+                if _tracked.get(ident) is counts:
+                    counts[stack] += 1
+        if finished is not None:
+            _save(finished['name'], finished['counts'])
+
+
+def _ensure_sampler():
+    # Started lazily so the thread is never created before a gunicorn fork
+    global _sampler
+    with _lock:
+        if _sampler is None or not _sampler.is_alive():
+            _sampler = threading.Thread(target=_sample_loop, name='profiler', daemon=True)
+            _sampler.start()
+
+
+def _speedscope(name, counts):
+    frames = []
+    frame_index = {}
+    samples = []
+    weights = []
+    for stack, count in counts.items():
+        sample = []
+        for entry in stack.split(';'):
+            if entry not in frame_index:
+                frame_index[entry] = len(frames)
+                frames.append({'name': entry})
+            sample.append(frame_index[entry])
+        samples.append(sample)
+        weights.append(count * PROFILE_INTERVAL_MS)
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'exporter': 'math-assistant profiler',
+        'shared': {'frames': frames},
+        'profiles': [{
+            'type': 'sampled',
+            'name': name,
+            'unit': 'milliseconds',
+            'startValue': 0,
+            'endValue': sum(weights),
+            'samples': samples,
+            'weights': weights
+        }]
+    }
+
+
+def _save(name, counts):
+    if not counts:
+        return
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(os.path.join(PROFILE_DIR, f'{name}.collapsed'), 'w', encoding='utf-8') as f:
+            for stack, count in counts.most_common():
+                f.write(f"{stack} {count}\n")
+        with open(os.path.join(PROFILE_DIR, f'{name}.speedscope.json'), 'w', encoding='utf-8') as f:
+            json.dump(_speedscope(name, counts), f)
+        _prune()
+    except OSError as e:
+        print(f"Error saving profile {name}: {e}")
+
+
+def _prune():
+    files = sorted((os.path.join(PROFILE_DIR, f) for f in os.listdir(PROFILE_DIR)), key=os.path.getmtime)
+    for path in files[:-PROFILE_MAX_FILES * 2]:
+        os.remove(path)
+
+
+def start_session(seconds):
+    """Start sampling every thread in this worker. Returns the profile name, or None if one is running."""
+    global _session
+    seconds = max(1, min(int(seconds), PROFILE_MAX_SECONDS))
+    name = f"manual-{time.strftime('%Y%m%d-%H%M%S')}-pid{os.getpid()}-{seconds}s"
+    with _lock:
+        if _session is not None:
+            return None
+        _session = {'name': name, 'until': time.time() + seconds, 'counts': Counter()}
+    _ensure_sampler()
+    return name
+
+
+def list_profiles():
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    profiles = []
+    for filename in os.listdir(PROFILE_DIR):
+        path = os.path.join(PROFILE_DIR, filename)
+        profiles.append({'file': filename, 'size': os.path.getsize(path), 'created': os.path.getmtime(path)})
+    return sorted(profiles, key=lambda p: p['created'], reverse=True)
+
+
+# Automatic slow-request capture
+
+def _before():
+    g.profile_thread = threading.get_ident()
+    g.profile_started = time.perf_counter()
+    g.profile_endpoint = request.endpoint
+    with _lock:
+        _tracked[g.profile_thread] = Counter()
+    _ensure_sampler()
+
+
+def _after(response):
+    ident = g.pop('profile_thread', None)
+    if ident is None:
+        return response
+    started = g.profile_started
+    endpoint = re.sub(r'[^A-Za-z0-9_]+', '_', g.get('profile_endpoint') or 'request').strip('_')
+
+    def finish():
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with _lock:
+            counts = _tracked.pop(ident, None)
+        if counts and elapsed_ms >= SLOW_REQUEST_PROFILE_MS:
+            _save(f"slow-{time.strftime('%Y%m%d-%H%M%S')}-pid{os.getpid()}-{next(_sequence)}"
+                  f"-{endpoint}-{elapsed_ms:.0f}ms", counts)
+
+    # Runs once the body has been sent, so streamed responses are timed in full
+    response.call_on_close(finish)
+    return response
+
+
+def init_app(app):
+    if SLOW_REQUEST_PROFILE_MS > 0:
+        app.before_request(_before)
+        app.after_request(_after)
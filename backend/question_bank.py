@@ -0,0 +1,257 @@
+"""Curated question bank, used before falling back to the LLM.
+
+Questions are bulk-loaded from text, CSV or JSON files and tagged by grade,
+subject, topic, difficulty and language. Each row gets a fixed random_key, and
+draw() picks the first unseen question at or after a fresh random point in a
+(bucket, random_key) index, wrapping around once. That keeps sampling to a
+short index scan instead of ORDER BY random() over the whole bucket, and
+records the question as seen by the user in the same statement.
+
+    python question_bank.py uploads/Algebra_-_Class_9.txt --difficulty 2
+    python question_bank.py worksheet.csv --grade "Class 8" --subject Math
+
+CSV/JSON columns: question, answer, grade, subject, topic, difficulty, language
+(missing columns fall back to the command-line options). Difficulty is 1-3 or
+easy/medium/hard, as in worksheets saved from /generate_set; rows with any
+other difficulty are skipped and reported. Text files are either
+chat transcripts downloaded from the app or plain worksheets with one question
+per blank-line-separated block and an optional "Answer:" line.
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import re
+import time
+import psycopg2
+import psycopg2.extras
+from db import get_db_connection
+
+QUESTION_BANK_ENABLED = os.getenv('QUESTION_BANK_ENABLED', 'true').lower() == 'true'
+BANK_MISS_TTL = float(os.getenv('QUESTION_BANK_MISS_TTL', '60'))
+
+# (user_id, bucket) -> time until which the bank is known to have nothing new
+_misses = {}
+
+# Labels used by /generate_set worksheets (gemini.DIFFICULTY_LABELS)
+DIFFICULTY_LEVELS = {'easy': 1, 'medium': 2, 'hard': 3}
+
+
+def normalize_grade(grade):
+    match = re.search(r'\d+', str(grade or ''))
+    return match.group() if match else str(grade or '').strip().lower()
+
+
+def normalize_language(language):
+    return 'Hindi' if str(language or '').strip().lower() in ('hindi', 'hi', 'हिंदी') else 'English'
+
+
+def parse_difficulty(difficulty):
+    """1-3 from a number or an easy/medium/hard label, or None if unrecognised."""
+    label = str(difficulty).strip().lower()
+    if label in DIFFICULTY_LEVELS:
+        return DIFFICULTY_LEVELS[label]
+    try:
+        return max(1, min(int(label), 3))
+    except ValueError:
+        return None
+
+
+def normalize_difficulty(difficulty):
+    parsed = parse_difficulty(difficulty) if difficulty is not None else None
+    return parsed or 1
+
+
+def _bucket(grade, subject, topic, difficulty, language):
+    return (normalize_grade(grade), str(subject or 'Math').strip().lower(),
+            str(topic or '').strip().lower(), normalize_difficulty(difficulty), normalize_language(language))
+
+
+# Parsing
+
+_SENDER = re.compile(r'^([^:\n]{1,40}): (.*)$')
+_NUMBERING = re.compile(r'^\s*(?:Q(?:uestion)?\s*)?\d+\s*[.):]\s*', re.IGNORECASE)
+
+
+def _parse_transcript(text, defaults):
+    """Questions from a chat transcript as downloaded from the sidebar."""
+    header = text.splitlines()[0][2:].strip()
+    row_defaults = dict(defaults)
+    if ' - ' in header:
+        topic, grade = header.rsplit(' - ', 1)
+        row_defaults.setdefault('topic', topic)
+        row_defaults.setdefault('grade', grade)
+
+    # Split into messages at lines that start with "Sender: "
+    messages = []
+    for line in text.splitlines()[2:]:
+        match = _SENDER.match(line)
+        if match:
+            messages.append([match.group(1), match.group(2)])
+        elif messages:
+            messages[-1][1] += '\n' + line
+
+    rows = []
+    for previous, current in zip(messages, messages[1:]):
+        # The assistant announces a question with "Generating a <topic> question for you..."
+        if previous[0] == 'Math Assistant' and 'question for you' in previous[1] and current[0] == 'Math Assistant':
+            rows.append(dict(row_defaults, question=re.sub(r'\n{3,}', '\n\n', current[1]).strip()))
+    return rows
+
+
+def _parse_worksheet(text, defaults):
+    rows = []
+    for block in re.split(r'\n\s*\n', text):
+        lines = [line for line in block.strip().splitlines() if line.strip()]
+        answer = None
+        if lines and lines[-1].lower().startswith('answer:'):
+            answer = lines.pop()[len('answer:'):].strip()
+        if lines:
+            lines[0] = _NUMBERING.sub('', lines[0])
+            rows.append(dict(defaults, question='\n'.join(lines).strip(), answer=answer))
+    return rows
+
+
+def parse_file(path, defaults):
+    extension = path.rsplit('.', 1)[-1].lower()
+    with open(path, encoding='utf-8') as f:
+        if extension == 'csv':
+            return [dict(defaults, **{k: v for k, v in row.items() if v}) for row in csv.DictReader(f)]
+        if extension in ('json', 'jsonl'):
+            text = f.read().strip()
+            items = json.loads(text) if text.startswith('[') else [json.loads(line) for line in text.splitlines() if line.strip()]
+            return [dict(defaults, **{k: v for k, v in item.items() if v not in (None, '')}) for item in items]
+        text = f.read()
+    if text.startswith('# ') and 'Math Assistant:' in text:
+        return _parse_transcript(text, defaults)
+    return _parse_worksheet(text, defaults)
+
+
+# Storage
+
+def ingest(rows, source=None):
+    """Bulk-insert parsed rows, skipping questions already in their bucket. Returns rows added."""
+    values = []
+    unrecognised = []
+    for row in rows:
+        question = str(row.get('question') or '').strip()
+        if len(question) < 10:
+            continue
+        # Never file a question under a guessed difficulty
+        if row.get('difficulty') not in (None, '') and parse_difficulty(row['difficulty']) is None:
+            unrecognised.append(row['difficulty'])
+            continue
+        grade, subject, topic, difficulty, language = _bucket(row.get('grade'), row.get('subject'), row.get('topic'),
+                                                              row.get('difficulty'), row.get('language'))
+        values.append((grade, subject, topic, difficulty, language, question, row.get('answer'), source))
+
+    if unrecognised:
+        print(f"Skipped {len(unrecognised)} questions with an unrecognised difficulty "
+              f"(e.g. {unrecognised[0]!r}); use 1-3 or easy/medium/hard")
+
+    if not values:
+        return 0
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    try:
+        inserted = psycopg2.extras.execute_values(cursor, '''
+        INSERT INTO question_bank (grade, subject, topic, difficulty, language, question, answer, source)
+        VALUES %s
+        ON CONFLICT DO NOTHING
+        RETURNING id
+        ''', values, page_size=500, fetch=True)
+        conn.commit()
+        return len(inserted)
+
+    except psycopg2.Error as e:
+        print(f"Error ingesting questions: {e}")
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def draw(user_id, grade, subject, topic=None, difficulty=1, language='English'):
+    """Pick a random question from the bucket that this user hasn't been served yet.
+
+    Returns {'id', 'question', 'answer'} or None when the bucket is exhausted.
+    """
+    grade, subject, topic, difficulty, language = _bucket(grade, subject, topic, difficulty, language)
+    miss_key = (user_id, grade, subject, topic, difficulty, language)
+    if _misses.get(miss_key, 0) > time.monotonic():
+        return None
+
+    params = {'user_id': user_id, 'grade': grade, 'subject': subject, 'topic': topic,
+              'difficulty': difficulty, 'language': language, 'point': random.random()}
+    bucket = 'grade = %(grade)s AND subject = %(subject)s AND language = %(language)s AND difficulty = %(difficulty)s'
+    if topic:
+        bucket += ' AND topic = %(topic)s'
+    unseen = 'NOT EXISTS (SELECT 1 FROM question_bank_seen s WHERE s.user_id = %(user_id)s AND s.question_id = q.id)'
+
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+    try:
+        # The second branch only runs if nothing unseen follows the random point
+        cursor.execute(f'''
+        WITH pick AS (
+            (SELECT id, question, answer FROM question_bank q
+             WHERE {bucket} AND random_key >= %(point)s AND {unseen}
+             ORDER BY random_key LIMIT 1)
+            UNION ALL
+            (SELECT id, question, answer FROM question_bank q
+             WHERE {bucket} AND random_key < %(point)s AND {unseen}
+             ORDER BY random_key LIMIT 1)
+            LIMIT 1
+        ),
+        mark AS (
+            INSERT INTO question_bank_seen (user_id, question_id)
+            SELECT %(user_id)s, id FROM pick
+            ON CONFLICT DO NOTHING
+        )
+        SELECT id, question, answer FROM pick
+        ''', params)
+
+        row = cursor.fetchone()
+        conn.commit()
+
+        if row is None:
+            if len(_misses) > 10000:
+                _misses.clear()
+            _misses[miss_key] = time.monotonic() + BANK_MISS_TTL
+            return None
+        return dict(row)
+
+    except psycopg2.Error as e:
+        print(f"Error drawing from question bank: {e}")
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--grade')
+    parser.add_argument('--subject', default='Math')
+    parser.add_argument('--topic')
+    parser.add_argument('--difficulty', default='1', help='1-3 or easy/medium/hard')
+    parser.add_argument('--language', default='English')
+    args = parser.parse_args()
+
+    defaults = {k: v for k, v in {'grade': args.grade, 'subject': args.subject, 'topic': args.topic,
+                                  'difficulty': args.difficulty, 'language': args.language}.items() if v is not None}
+    for path in args.files:
+        rows = parse_file(path, defaults)
+        added = ingest(rows, source=os.path.basename(path))
+        print(f"{path}: parsed {len(rows)} questions, added {added}")
+
+
+if __name__ == '__main__':
+    main()
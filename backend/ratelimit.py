@@ -0,0 +1,264 @@
+"""Rate limiting and daily LLM quotas.
+
+Requests are throttled with GCRA (generic cell rate algorithm): each key stores
+a single "theoretical arrival time", so a check is one dict lookup in memory or
+one script call in Redis. Every endpoint has a cost weight, charged against:
+
+- a per-minute rate with a burst allowance (per user, or per IP for /login)
+- a daily quota of LLM cost units per user, reset at UTC midnight
+
+The in-memory backend is per worker process. Set RATE_LIMIT_BACKEND=redis to
+share counters between workers through a local Redis-compatible server.
+Backend errors fail open so a Redis outage never takes the API down.
+"""
+import json
+import math
+import os
+import threading
+import time
+from collections import namedtuple
+from functools import wraps
+from flask import request, jsonify, make_response
+from dotenv import load_dotenv
+
+load_dotenv()
+
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory')  # memory | redis
+RATE_LIMIT_REDIS_URL = os.getenv('RATE_LIMIT_REDIS_URL', 'redis://localhost:6379/0')
+# Number of trusted reverse proxies in front of the app (0 = use the socket address).
+# Each proxy appends the address it saw to X-Forwarded-For, so only the rightmost
+# entries can be trusted; anything further left is supplied by the client.
+RATE_LIMIT_PROXY_HOPS = int(os.getenv('RATE_LIMIT_PROXY_HOPS', '0'))
+
+# Cost units per minute and burst size, per user / per IP
+USER_RATE_PER_MINUTE = float(os.getenv('RATE_LIMIT_PER_MINUTE', '30'))
+USER_BURST = float(os.getenv('RATE_LIMIT_BURST', '10'))
+LOGIN_RATE_PER_MINUTE = float(os.getenv('LOGIN_RATE_LIMIT_PER_MINUTE', '10'))
+LOGIN_BURST = float(os.getenv('LOGIN_RATE_LIMIT_BURST', '5'))
+
+# LLM cost units per user per UTC day (0 disables the quota)
+DAILY_LLM_QUOTA = int(os.getenv('DAILY_LLM_QUOTA', '300'))
+
+# Cost weight per endpoint; override with RATE_LIMIT_COSTS='{"generate_set": 10}'
+ENDPOINT_COSTS = {
+    'login': 1,
+    'register': 1,
+    'generate': 1,
+    'generate_stream': 1,
+    'answer': 1,
+    'answer_stream': 1,
+    'direct_question': 2,
+    'direct_question_stream': 2,
+    'upload_question': 2,
+    'generate_set': 5,
+}
+ENDPOINT_COSTS.update(json.loads(os.getenv('RATE_LIMIT_COSTS', '{}')))
+
+# Drained keys are dropped once the in-memory table grows past this many entries
+MEMORY_PRUNE_THRESHOLD = 10000
+
+Decision = namedtuple('Decision', 'allowed limit remaining reset retry_after quota_remaining')
+
+
+class MemoryBackend:
+    """Per-process counters guarded by a single lock."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tat = {}
+        self._quota = {}
+        self._quota_day = None
+        self._prune_at = MEMORY_PRUNE_THRESHOLD
+
+    def gcra(self, key, interval, capacity, cost):
+        """Returns (allowed, remaining, reset, retry_after), times in seconds."""
+        now = time.monotonic()
+        limit = interval * capacity
+        with self._lock:
+            tat = max(self._tat.get(key, now), now)
+            new_tat = tat + interval * cost
+            if new_tat - now > limit:
+                return False, int((limit - (tat - now)) / interval), tat - now, new_tat - now - limit
+            self._tat[key] = new_tat
+            # Keys that have fully drained carry no state, so drop them occasionally.
+            # The next prune waits until the table doubles, so when most keys are
+            # still active the O(n) rebuild stays amortised O(1) per call.
+            if len(self._tat) > self._prune_at:
+                self._tat = {k: v for k, v in self._tat.items() if v > now}
+                self._prune_at = max(MEMORY_PRUNE_THRESHOLD, 2 * len(self._tat))
+        return True, int((limit - (new_tat - now)) / interval), new_tat - now, 0
+
+    def consume_quota(self, key, cost, quota, day):
+        """Charge `cost` against today's quota. Returns (allowed, remaining)."""
+        with self._lock:
+            if day != self._quota_day:
+                self._quota = {}
+                self._quota_day = day
+            used = self._quota.get(key, 0)
+            if used + cost > quota:
+                return False, quota - used
+            self._quota[key] = used + cost
+        return True, quota - used - cost
+
+
+# GCRA in a single round-trip. Uses the server clock so every worker agrees on time.
+_GCRA_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local interval = tonumber(ARGV[1])
+local limit = interval * tonumber(ARGV[2])
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+if tat < now then tat = now end
+local new_tat = tat + interval * tonumber(ARGV[3])
+if new_tat - now > limit then
+  return {0, tostring(tat - now), tostring(new_tat - now - limit)}
+end
+redis.call('SET', KEYS[1], tostring(new_tat), 'PX', math.ceil((new_tat - now) * 1000))
+return {1, tostring(new_tat - now), '0'}
+"""
+
+_QUOTA_SCRIPT = """
+local used = redis.call('INCRBY', KEYS[1], ARGV[1])
+if used == tonumber(ARGV[1]) then redis.call('EXPIRE', KEYS[1], 90000) end
+if used > tonumber(ARGV[2]) then
+  redis.call('DECRBY', KEYS[1], ARGV[1])
+  return {0, tonumber(ARGV[2]) - used + tonumber(ARGV[1])}
+end
+return {1, tonumber(ARGV[2]) - used}
+"""
+
+
+class RedisBackend:
+    """Counters shared by all workers through a Redis-compatible server."""
+
+    def __init__(self, url):
+        import redis
+        self._client = redis.Redis.from_url(url, socket_timeout=0.05)
+        self._gcra = self._client.register_script(_GCRA_SCRIPT)
+        self._quota = self._client.register_script(_QUOTA_SCRIPT)
+
+    def gcra(self, key, interval, capacity, cost):
+        ok, tat_offset, retry_after = self._gcra(keys=[f'rl:{key}'], args=[interval, capacity, cost])
+        tat_offset, retry_after = float(tat_offset), float(retry_after)
+        remaining = int((interval * capacity - tat_offset) / interval)
+        return bool(ok), remaining, tat_offset, retry_after
+
+    def consume_quota(self, key, cost, quota, day):
+        ok, remaining = self._quota(keys=[f'quota:{day}:{key}'], args=[cost, quota])
+        return bool(ok), int(remaining)
+
+
+# Backend is created lazily so no client or lock is shared across a fork
+_backend = None
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        if RATE_LIMIT_BACKEND == 'redis':
+            _backend = RedisBackend(RATE_LIMIT_REDIS_URL)
+        else:
+            _backend = MemoryBackend()
+    return _backend
+
+
+def client_ip():
+    if RATE_LIMIT_PROXY_HOPS > 0:
+        hops = [hop.strip() for hop in request.headers.get('X-Forwarded-For', '').split(',') if hop.strip()]
+        if len(hops) >= RATE_LIMIT_PROXY_HOPS:
+            return hops[-RATE_LIMIT_PROXY_HOPS]
+    return request.remote_addr or 'unknown'
+
+
+def _consume_quota(backend, quota_key, cost):
+    day = time.strftime('%Y-%m-%d', time.gmtime())
+    return backend.consume_quota(quota_key, cost, DAILY_LLM_QUOTA, day)
+
+
+def _seconds_until_quota_reset():
+    # Quotas reset at UTC midnight
+    return 86400 - time.time() % 86400
+
+
+def check(key, endpoint, per_minute, burst, quota_key=None):
+    """Charge one request to `endpoint` against `key` and return a Decision."""
+    cost = ENDPOINT_COSTS.get(endpoint, 1)
+    interval = 60.0 / per_minute
+    try:
+        backend = get_backend()
+        allowed, remaining, reset, retry_after = backend.gcra(key, interval, burst, cost)
+        quota_remaining = None
+        if allowed and quota_key is not None and DAILY_LLM_QUOTA > 0:
+            allowed, quota_remaining = _consume_quota(backend, quota_key, cost)
+            if not allowed:
+                retry_after = _seconds_until_quota_reset()
+    except Exception as e:
+        print(f"Rate limit backend error, allowing request: {e}")
+        return None
+    return Decision(allowed, int(burst), max(remaining, 0), reset, retry_after, quota_remaining)
+
+
+def _apply_headers(response, decision):
+    response.headers['RateLimit-Limit'] = str(decision.limit)
+    response.headers['RateLimit-Remaining'] = str(decision.remaining)
+    response.headers['RateLimit-Reset'] = str(math.ceil(decision.reset))
+    if decision.quota_remaining is not None:
+        response.headers['X-LLM-Quota-Remaining'] = str(max(decision.quota_remaining, 0))
+    if not decision.allowed:
+        response.headers['Retry-After'] = str(math.ceil(decision.retry_after))
+    return response
+
+
+def rate_limit(endpoint, by='user', quota=True):
+    """Throttle a route.
+
+    by='user' must be stacked under @token_required and also charges the daily
+    LLM quota; by='ip' keys on the client address (for /login and /register).
+    Routes that only sometimes call the LLM pass quota=False and call
+    charge_quota() themselves once they know they need it.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if not RATE_LIMIT_ENABLED:
+                return f(*args, **kwargs)
+
+            if by == 'user':
+                user_id = args[0]['id']
+                decision = check(f'user:{user_id}', endpoint, USER_RATE_PER_MINUTE, USER_BURST,
+                                 quota_key=f'user:{user_id}' if quota else None)
+            else:
+                decision = check(f'ip:{endpoint}:{client_ip()}', endpoint, LOGIN_RATE_PER_MINUTE, LOGIN_BURST)
+
+            if decision is None:
+                return f(*args, **kwargs)
+
+            if not decision.allowed:
+                message = 'Daily limit reached, please try again tomorrow.' if decision.quota_remaining is not None \
+                    else 'Too many requests, please slow down.'
+                return _apply_headers(make_response(jsonify({'message': message}), 429), decision)
+
+            return _apply_headers(make_response(f(*args, **kwargs)), decision)
+
+        return decorated
+    return decorator
+
+
+def charge_quota(user_id, endpoint):
+    """Charge `endpoint`'s cost against the user's daily LLM quota on its own.
+
+    Returns a 429 response when the quota is used up, otherwise None.
+    """
+    if not RATE_LIMIT_ENABLED or DAILY_LLM_QUOTA <= 0:
+        return None
+    try:
+        allowed, remaining = _consume_quota(get_backend(), f'user:{user_id}', ENDPOINT_COSTS.get(endpoint, 1))
+    except Exception as e:
+        print(f"Rate limit backend error, allowing request: {e}")
+        return None
+    if allowed:
+        return None
+    response = make_response(jsonify({'message': 'Daily limit reached, please try again tomorrow.'}), 429)
+    response.headers['X-LLM-Quota-Remaining'] = str(max(remaining, 0))
+    response.headers['Retry-After'] = str(math.ceil(_seconds_until_quota_reset()))
+    return response
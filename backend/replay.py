@@ -0,0 +1,292 @@
+"""Capture-and-replay load testing against a running backend.
+
+1. Export a time-ordered workload, either from the `interactions` table or
+   from a request log written with CAPTURE_REQUESTS_FILE (see instrumentation.py):
+
+    python replay.py export --out workload.jsonl --since 2025-06-01
+    python replay.py export --out workload.jsonl --from-log requests.log
+
+2. Start the target with the stub model and query counting, and without
+   rate limiting (every replayed request uses the same account):
+
+    LLM_STUB=true DB_QUERY_COUNTING=true RATE_LIMIT_ENABLED=false gunicorn app:app
+
+3. Replay it at 1x or faster, then read the per-endpoint report:
+
+    python replay.py run workload.jsonl --url http://localhost:8000 \\
+        --email load@example.com --password secret --speed 10 --concurrency 32
+
+Requests are scheduled open-loop at their recorded offsets (divided by
+--speed). Latency is measured from each request's scheduled time, not from
+when a client thread picked it up, so time spent queued behind --concurrency
+is included and a slow backend shows up as growing latency. The queue delay
+is also reported on its own (qp99) to tell client saturation from server delay.
+The stub model answers with the response length recorded for each request.
+"""
+import argparse
+import json
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+STREAM_PATHS = {'/generate_stream', '/answer_stream', '/direct_question_stream', '/generate_set'}
+SKIPPED_PATHS = ('/login', '/register', '/logout', '/admin')
+
+
+# Export
+
+def _interaction_to_request(row, stream):
+    """Work out which endpoint produced an interactions row and rebuild its request."""
+    body = {'grade': row['grade'], 'subject': row['subject'], 'topic': row['topic']}
+    if row['answer']:
+        path = '/answer_stream' if stream else '/answer'
+        body.update(question=row['question'], answer=row['answer'])
+        length = len(row['feedback'] or '')
+    elif row['feedback']:
+        path = '/direct_question_stream' if stream else '/direct_question'
+        body.update(question=row['question'])
+        length = len(row['feedback'])
+    else:
+        path = '/generate_stream' if stream else '/generate'
+        body.update(difficultyLevel=1)
+        length = len(row['question'] or '')
+    return {'method': 'POST', 'path': path, 'body': body, 'response_length': length}
+
+
+def _set_request(rows):
+    """Rebuild the single /generate_set request that logged a worksheet's rows."""
+    topics = list(dict.fromkeys(row['topic'] for row in rows if row['topic']))
+    body = {'grade': rows[0]['grade'], 'subject': rows[0]['subject'], 'count': len(rows)}
+    if topics:
+        body['topics'] = topics
+    return {'method': 'POST', 'path': '/generate_set', 'body': body, 'response_length': None}
+
+
+def export_interactions(since=None, limit=None, stream=True):
+    import psycopg2.extras
+    from db import get_db_connection
+
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    try:
+        cursor.execute('''
+        SELECT timestamp, grade, subject, topic, question, answer, feedback, set_id
+        FROM interactions
+        WHERE %s IS NULL OR timestamp >= %s::timestamp
+        ORDER BY timestamp
+        LIMIT %s
+        ''', (since, since, limit))
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+        conn.close()
+
+    if not rows:
+        return []
+    first = rows[0]['timestamp']
+    workload = []
+    sets = {}
+    for row in rows:
+        # A worksheet logs one row per question; replay it as the one request it was
+        if row['set_id']:
+            if row['set_id'] not in sets:
+                sets[row['set_id']] = []
+                workload.append({'offset': (row['timestamp'] - first).total_seconds(), 'set_rows': sets[row['set_id']]})
+            sets[row['set_id']].append(row)
+            continue
+        item = _interaction_to_request(row, stream)
+        item['offset'] = (row['timestamp'] - first).total_seconds()
+        workload.append(item)
+
+    for i, item in enumerate(workload):
+        if 'set_rows' in item:
+            workload[i] = dict(_set_request(item['set_rows']), offset=item['offset'])
+    return workload
+
+
+def export_request_log(path):
+    workload = []
+    first = None
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry['path'].startswith(SKIPPED_PATHS):
+                continue
+            if first is None:
+                first = entry['ts']
+            workload.append({
+                'offset': entry['ts'] - first,
+                'method': entry['method'],
+                'path': entry['path'],
+                'body': entry.get('body'),
+                # Only recorded for non-streamed responses
+                'response_length': entry.get('response_length')
+            })
+    return workload
+
+
+# Replay
+
+def _endpoint_key(method, path):
+    return f"{method} {re.sub(r'/[0-9]+(?=/|$)', '/<id>', path)}"
+
+
+def login(url, email, password):
+    req = urllib.request.Request(url + '/login', data=json.dumps({'email': email, 'password': password}).encode(),
+                                 headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req, timeout=30) as resp:
+        return json.loads(resp.read())['token']
+
+
+def send(url, token, item, timeout):
+    """Send one request and read the whole body.
+
+    Returns (sent_at, finished_at, status, db_queries, error), times from perf_counter().
+    """
+    headers = {'Authorization': f'Bearer {token}'}
+    data = None
+    if item.get('body') is not None:
+        data = json.dumps(item['body']).encode()
+        headers['Content-Type'] = 'application/json'
+    if item.get('response_length'):
+        headers['X-Stub-Response-Length'] = str(item['response_length'])
+
+    req = urllib.request.Request(url + item['path'], data=data, headers=headers, method=item['method'])
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            body = resp.read()
+            status = resp.status
+            db_queries = resp.headers.get('X-DB-Queries')
+    except urllib.error.HTTPError as e:
+        e.read()
+        return start, time.perf_counter(), e.code, e.headers.get('X-DB-Queries'), True
+    except (urllib.error.URLError, OSError):
+        return start, time.perf_counter(), None, None, True
+
+    # Streams report failures in-band with a 200 status
+    error = item['path'] in STREAM_PATHS and b'"error"' in body
+    return start, time.perf_counter(), status, db_queries, error
+
+
+def replay(workload, url, token, speed=1.0, concurrency=16, timeout=120):
+    results = defaultdict(list)
+    lock = threading.Lock()
+
+    def run_one(item, due):
+        sent_at, finished_at, status, db_queries, error = send(url, token, item, timeout)
+        # Measured from the scheduled time, so queueing behind busy client threads counts
+        with lock:
+            results[_endpoint_key(item['method'], item['path'])].append(
+                (finished_at - due, status, int(db_queries) if db_queries else None, error, sent_at - due))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i, item in enumerate(workload):
+            due = start + item['offset'] / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(run_one, item, due)
+            if (i + 1) % 100 == 0:
+                print(f"  sent {i + 1}/{len(workload)}", file=sys.stderr)
+
+    return results, time.perf_counter() - start
+
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(results):
+    summary = {}
+    for endpoint, samples in sorted(results.items()):
+        latencies = sorted(s[0] * 1000 for s in samples)
+        queue_delays = sorted(max(s[4], 0) * 1000 for s in samples)
+        queries = [s[2] for s in samples if s[2] is not None]
+        summary[endpoint] = {
+            'requests': len(samples),
+            'error_rate': sum(1 for s in samples if s[3]) / len(samples),
+            'throttled': sum(1 for s in samples if s[1] == 429),
+            'p50_ms': _percentile(latencies, 50),
+            'p90_ms': _percentile(latencies, 90),
+            'p99_ms': _percentile(latencies, 99),
+            'max_ms': latencies[-1],
+            'queue_p99_ms': _percentile(queue_delays, 99),
+            'db_queries_avg': sum(queries) / len(queries) if queries else None
+        }
+    return summary
+
+
+def print_report(summary, duration):
+    print(f"{'endpoint':<34}{'reqs':>7}{'err%':>7}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}{'qp99':>9}{'dbq':>6}")
+    for endpoint, s in summary.items():
+        dbq = f"{s['db_queries_avg']:.1f}" if s['db_queries_avg'] is not None else '-'
+        print(f"{endpoint:<34}{s['requests']:>7}{s['error_rate'] * 100:>6.1f}%"
+              f"{s['p50_ms']:>9.0f}{s['p90_ms']:>9.0f}{s['p99_ms']:>9.0f}{s['max_ms']:>9.0f}{s['queue_p99_ms']:>9.0f}{dbq:>6}")
+    print(f"\nReplayed in {duration:.1f}s (latencies in ms from each request's scheduled time;"
+          f" qp99 is the p99 wait for a free client thread)")
+    if any(s['queue_p99_ms'] > 100 for s in summary.values()):
+        print("Requests queued in the client; raise --concurrency if the target is not the bottleneck")
+    if any(s['throttled'] for s in summary.values()):
+        print("Some requests were rate limited (429); run the target with RATE_LIMIT_ENABLED=false")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export = commands.add_parser('export', help='write a workload file')
+    export.add_argument('--out', required=True)
+    export.add_argument('--from-log', help='request log written with CAPTURE_REQUESTS_FILE')
+    export.add_argument('--since', help='only interactions at or after this timestamp')
+    export.add_argument('--limit', type=int)
+    export.add_argument('--no-stream', action='store_true', help='use the non-streaming endpoints')
+
+    run = commands.add_parser('run', help='replay a workload file')
+    run.add_argument('workload')
+    run.add_argument('--url', default='http://localhost:5000')
+    run.add_argument('--token')
+    run.add_argument('--email')
+    run.add_argument('--password')
+    run.add_argument('--speed', type=float, default=1.0)
+    run.add_argument('--concurrency', type=int, default=16)
+    run.add_argument('--timeout', type=float, default=120)
+    run.add_argument('--json', help='also write the summary to this file')
+
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        if args.from_log:
+            workload = export_request_log(args.from_log)
+        else:
+            workload = export_interactions(args.since, args.limit, stream=not args.no_stream)
+        with open(args.out, 'w', encoding='utf-8') as f:
+            for item in workload:
+                f.write(json.dumps(item) + '\n')
+        print(f"Wrote {len(workload)} requests to {args.out}")
+        return
+
+    with open(args.workload, encoding='utf-8') as f:
+        workload = [json.loads(line) for line in f if line.strip()]
+    url = args.url.rstrip('/')
+    token = args.token or login(url, args.email, args.password)
+
+    results, duration = replay(workload, url, token, args.speed, args.concurrency, args.timeout)
+    summary = summarize(results)
+    print_report(summary, duration)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Fast JSON responses and response compression.
+
+- OrjsonProvider makes jsonify use orjson when it is installed
+- raw_json_response sends JSON text built by Postgres without decoding it
+- compress_response gzip/brotli-encodes large non-streamed responses
+"""
+import gzip
+import os
+from flask import Response, request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', '6'))
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', '4'))
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/plain', 'text/html'}
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """jsonify backed by orjson, falling back to the stdlib for anything it can't handle.
+
+    Datetimes are passed through to DefaultJSONProvider.default so they keep
+    Flask's HTTP-date format.
+    """
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs.get('indent'):
+            return super().dumps(obj, **kwargs)
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(obj, default=self.default, option=option).decode()
+        except TypeError:
+            return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+
+def raw_json_response(json_text, status=200):
+    """Send JSON text that is already serialized (e.g. by json_build_object) as-is."""
+    return Response(json_text, status=status, mimetype='application/json')
+
+
+def _accepted_encodings():
+    accept = request.headers.get('Accept-Encoding', '')
+    return {part.split(';')[0].strip().lower() for part in accept.split(',')}
+
+
+def compress_response(response):
+    """after_request hook: compress large, complete responses the client can decode."""
+    if (response.status_code < 200 or response.status_code >= 300
+            or response.is_streamed or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    encodings = _accepted_encodings()
+    if brotli is not None and 'br' in encodings:
+        response.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+        response.headers['Content-Encoding'] = 'br'
+    elif 'gzip' in encodings:
+        response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL))
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    return response
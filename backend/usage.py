@@ -0,0 +1,178 @@
+"""LLM token usage accounting and per-feature output budgets.
+
+gemini.py reports every model call here with the usage metadata Gemini
+returns (prompt, output and cached tokens) and its latency. Calls are summed
+in memory per (day, endpoint, feature, user) and upserted into the
+`llm_usage_daily` table at most every USAGE_FLUSH_SECONDS, so accounting
+costs one small write per worker per interval rather than one per call.
+
+The endpoint and user are taken from the request by token_required via
+set_request_context(), because streamed model calls run after the view
+function has returned. init_app() clears it at the start of every request so
+a pooled worker thread never charges one request's calls to the previous user.
+"""
+import atexit
+import contextvars
+import datetime
+import json
+import os
+import threading
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+USAGE_FLUSH_SECONDS = float(os.getenv('USAGE_FLUSH_SECONDS', '30'))
+
+# USD per million tokens, for the report's cost estimate
+INPUT_PRICE_PER_M = float(os.getenv('GEMINI_INPUT_PRICE_PER_M', '0.075'))
+OUTPUT_PRICE_PER_M = float(os.getenv('GEMINI_OUTPUT_PRICE_PER_M', '0.30'))
+CACHED_PRICE_PER_M = float(os.getenv('GEMINI_CACHED_PRICE_PER_M', '0.01875'))
+
+# max_output_tokens per feature; override with LLM_MAX_OUTPUT_TOKENS='{"evaluate_answer": 800}'
+OUTPUT_TOKEN_BUDGETS = {
+    'generate_question': 300,
+    'evaluate_answer': 1200,
+    'answer_direct_question': 1500,
+    'generate_question_set': 4096,
+}
+OUTPUT_TOKEN_BUDGETS.update(json.loads(os.getenv('LLM_MAX_OUTPUT_TOKENS', '{}')))
+
+REPORT_GROUPS = {
+    'endpoint': 'endpoint',
+    'feature': 'feature',
+    'user': 'user_id',
+    'day': 'day',
+}
+
+_request_context = contextvars.ContextVar('llm_usage_context', default=('unknown', 0))
+_lock = threading.Lock()
+_pending = {}
+_last_flush = time.monotonic()
+
+
+def set_request_context(endpoint, user_id):
+    _request_context.set((endpoint or 'unknown', user_id or 0))
+
+
+def clear_request_context():
+    _request_context.set(('unknown', 0))
+
+
+def generation_config(feature):
+    budget = OUTPUT_TOKEN_BUDGETS.get(feature)
+    return {'max_output_tokens': budget} if budget else None
+
+
+def record(feature, usage_metadata, latency_seconds):
+    """Add one model call to the in-memory totals and flush them if they are due."""
+    global _last_flush
+    endpoint, user_id = _request_context.get()
+    key = (datetime.datetime.now(datetime.timezone.utc).date(), endpoint, feature, user_id)
+    prompt = getattr(usage_metadata, 'prompt_token_count', 0) or 0
+    output = getattr(usage_metadata, 'candidates_token_count', 0) or 0
+    cached = getattr(usage_metadata, 'cached_content_token_count', 0) or 0
+
+    with _lock:
+        totals = _pending.setdefault(key, [0, 0, 0, 0, 0.0])
+        totals[0] += 1
+        totals[1] += prompt
+        totals[2] += output
+        totals[3] += cached
+        totals[4] += latency_seconds * 1000
+        due = time.monotonic() - _last_flush >= USAGE_FLUSH_SECONDS
+        if due:
+            _last_flush = time.monotonic()
+
+    if due:
+        flush()
+
+
+def flush():
+    """Upsert the pending totals into llm_usage_daily."""
+    global _pending
+    with _lock:
+        pending, _pending = _pending, {}
+    if not pending:
+        return
+
+    import psycopg2
+    import psycopg2.extras
+    from db import get_db_connection
+
+    try:
+        conn = get_db_connection()
+    except psycopg2.Error as e:
+        print(f"Error flushing LLM usage: {e}")
+        return
+    cursor = conn.cursor()
+
+    try:
+        psycopg2.extras.execute_values(cursor, '''
+        INSERT INTO llm_usage_daily (day, endpoint, feature, user_id, calls, prompt_tokens, output_tokens, cached_tokens, latency_ms)
+        VALUES %s
+        ON CONFLICT (day, endpoint, feature, user_id) DO UPDATE SET
+            calls = llm_usage_daily.calls + EXCLUDED.calls,
+            prompt_tokens = llm_usage_daily.prompt_tokens + EXCLUDED.prompt_tokens,
+            output_tokens = llm_usage_daily.output_tokens + EXCLUDED.output_tokens,
+            cached_tokens = llm_usage_daily.cached_tokens + EXCLUDED.cached_tokens,
+            latency_ms = llm_usage_daily.latency_ms + EXCLUDED.latency_ms
+        ''', [key + tuple(totals) for key, totals in pending.items()])
+
+        conn.commit()
+
+    except psycopg2.Error as e:
+        print(f"Error flushing LLM usage: {e}")
+        conn.rollback()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+atexit.register(flush)
+
+
+def report(days=7, group_by='endpoint'):
+    """Usage totals for the last `days` days grouped by endpoint, feature, user or day."""
+    import psycopg2.extras
+    from db import get_db_connection
+
+    column = REPORT_GROUPS[group_by]
+    flush()
+
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+    try:
+        cursor.execute(f'''
+        SELECT {column} AS key,
+               SUM(calls) AS calls,
+               SUM(prompt_tokens) AS prompt_tokens,
+               SUM(output_tokens) AS output_tokens,
+               SUM(cached_tokens) AS cached_tokens,
+               SUM(latency_ms) / NULLIF(SUM(calls), 0) AS avg_latency_ms
+        FROM llm_usage_daily
+        WHERE day > CURRENT_DATE - %s
+        GROUP BY {column}
+        ''', (days,))
+        rows = [dict(row) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+        conn.close()
+
+    for row in rows:
+        row['key'] = str(row['key'])
+        for field in ('calls', 'prompt_tokens', 'output_tokens', 'cached_tokens'):
+            row[field] = int(row[field] or 0)
+        row['avg_latency_ms'] = round(float(row['avg_latency_ms'] or 0), 1)
+        row['estimated_cost_usd'] = round(
+            ((row['prompt_tokens'] - row['cached_tokens']) * INPUT_PRICE_PER_M
+             + row['cached_tokens'] * CACHED_PRICE_PER_M
+             + row['output_tokens'] * OUTPUT_PRICE_PER_M) / 1_000_000, 4)
+
+    return sorted(rows, key=lambda row: row['estimated_cost_usd'], reverse=True)
+
+
+def init_app(app):
+    # Cleared before (not after) each request: a streamed body still needs it after teardown
+    app.before_request(clear_request_context)